@@ -0,0 +1,160 @@
+"""
+Incremental detection of chronic absence.
+
+Every student with attendance has an AbsenceTracker : the current absence streak and a bitset of the attendance
+of the student's last WINDOW_DAYS school days. Saving attendance moves the trackers of the students whose attendance
+changed by the day saved, so no attendance is counted again. A student is at risk when absent STREAK_DAYS days in
+a row, or present less than MIN_PERCENTAGE percent of the days of the window.
+The at risk lists of a class or of the school are read from the indexed at_risk flag.
+
+Settings :
+* ABSENCE_STREAK_DAYS : consecutive days absent to be at risk, 3 by default
+* ABSENCE_WINDOW_DAYS : school days of the rolling window, 20 by default, at most 62 as the window is a BigIntegerField
+* ABSENCE_MIN_PERCENTAGE : percentage present over the window below which a student is at risk, 75 by default
+"""
+from collections import defaultdict
+
+from django.conf import settings
+
+from attendance.attendance_store import get_store, popcount
+from attendance.models import AbsenceTracker
+from attendance.rollups import as_day
+
+STREAK_DAYS = getattr(settings, 'ABSENCE_STREAK_DAYS', 3)
+WINDOW_DAYS = min(getattr(settings, 'ABSENCE_WINDOW_DAYS', 20), 62)
+MIN_PERCENTAGE = getattr(settings, 'ABSENCE_MIN_PERCENTAGE', 75)
+
+WINDOW_MASK = (1 << WINDOW_DAYS) - 1
+
+# students counted per query by build_trackers
+BATCH_SIZE = 500
+
+FIELDS = ('last_day', 'streak', 'streak_before', 'window', 'window_days', 'at_risk')
+
+
+def is_at_risk(streak, window, window_days):
+    if streak >= STREAK_DAYS:
+        return True
+    return window_days > 0 and popcount(window) * 100 < MIN_PERCENTAGE * window_days
+
+
+def _add_day(tracker, day, is_present):
+    """
+    Moves the tracker to day, a school day after its last_day
+    """
+    tracker.streak_before = tracker.streak
+    tracker.streak = 0 if is_present else tracker.streak + 1
+    tracker.window = (tracker.window << 1 | int(is_present)) & WINDOW_MASK
+    tracker.window_days = min(tracker.window_days + 1, WINDOW_DAYS)
+    tracker.last_day = day
+
+
+def _edit_last_day(tracker, is_present):
+    tracker.streak = 0 if is_present else tracker.streak_before + 1
+    tracker.window = tracker.window & ~1 | int(is_present)
+
+
+def _days_absent(days):
+    """
+    returns the number of days absent at the start of days, a list of (date, is_present)
+    """
+    absent = 0
+    for _, is_present in days:
+        if is_present:
+            break
+        absent += 1
+    return absent
+
+
+def _recount(tracker, days):
+    """
+    Sets the tracker from days, the whole attendance of the student newest first (see the history of the stores)
+    """
+    tracker.last_day = days[0][0]
+    tracker.streak = _days_absent(days)
+    tracker.streak_before = tracker.streak - 1 if tracker.streak else _days_absent(days[1:])
+    window = days[:WINDOW_DAYS]
+    tracker.window = sum(1 << number for number, (_, is_present) in enumerate(window) if is_present)
+    tracker.window_days = len(window)
+    tracker.at_risk = is_at_risk(tracker.streak, tracker.window, tracker.window_days)
+
+
+def track_changes(changes):
+    """
+    Moves the trackers of the students of changes, a list of (student_id, day, present_change, total_change) of
+    the attendance already saved in the store, creating the missing ones.
+    returns the new values of the existing trackers that changed, a dictionary of id -> field -> value
+    to be written with helper.bulk_update.
+
+    This has to be called in the same transaction that saves the attendance.
+    """
+    days_of = defaultdict(list)
+    for student_id, day, present_change, total_change in changes:
+        if present_change != 0 or total_change != 0:
+            # a saved change is a new day or a changed one, present_change is 1 when present on it
+            days_of[student_id].append((as_day(day), present_change == 1))
+    if not days_of:
+        return {}
+    trackers = {tracker.student_id: tracker for tracker in AbsenceTracker.objects.select_for_update().filter(
+        student_id__in=days_of)}
+    moved = {}
+    # students without a tracker, or with back dated attendance, are counted again from the store,
+    # which already has the saved attendance, all of them with one query
+    recount_ids = set(days_of) - set(trackers)
+    for student_id, tracker in trackers.items():
+        for day, is_present in sorted(days_of[student_id]):
+            if day > tracker.last_day:
+                _add_day(tracker, day, is_present)
+            elif day == tracker.last_day:
+                _edit_last_day(tracker, is_present)
+            else:
+                recount_ids.add(student_id)
+                break
+        else:
+            tracker.at_risk = is_at_risk(tracker.streak, tracker.window, tracker.window_days)
+            moved[tracker.id] = tracker
+    new_trackers = []
+    for student_id, days in get_store().history(recount_ids).items() if recount_ids else ():
+        tracker = trackers.get(student_id)
+        if tracker is None:
+            tracker = AbsenceTracker(student_id=student_id)
+            new_trackers.append(tracker)
+        else:
+            moved[tracker.id] = tracker
+        _recount(tracker, days)
+    AbsenceTracker.objects.bulk_create(new_trackers)
+    return {tracker_id: {field: getattr(tracker, field) for field in FIELDS} for tracker_id, tracker in moved.items()}
+
+
+def build_trackers(student_ids, store=None):
+    """
+    returns unsaved trackers of the students in student_ids who have attendance, counted from store, by default
+    the store of the settings, with one query per BATCH_SIZE students
+    """
+    student_ids = list(student_ids)
+    store = store or get_store()
+    trackers = []
+    for start in range(0, len(student_ids), BATCH_SIZE):
+        for student_id, days in store.history(student_ids[start:start + BATCH_SIZE]).items():
+            tracker = AbsenceTracker(student_id=student_id)
+            _recount(tracker, days)
+            trackers.append(tracker)
+    return trackers
+
+
+####################################################
+#           Reading                                #
+####################################################
+
+
+def at_risk_list(class_id=None):
+    """
+    returns the trackers of the students at risk of the class, or of the whole school when class_id is None,
+    with their students
+    """
+    trackers = AbsenceTracker.objects.filter(at_risk=True)
+    if class_id is not None:
+        return trackers.filter(student__which_class_id=class_id).select_related('student').order_by(
+            'student__roll_no')
+    return trackers.select_related('student__which_class').order_by(
+        'student__which_class__grade', 'student__which_class__division', 'student__roll_no')
@@ -0,0 +1,110 @@
+"""
+Archival of the attendance and marks of past academic years.
+
+The close_academic_year command moves the Attendance rows and the Marks of the tests of past academic years into
+AttendanceArchive and MarksArchive, in batches, so the live tables and their indexes only hold the current year.
+The attendance counts of the reports come from the rollups and prefix rows, which are kept for every year.
+The reports only show the tests of the live year, and read the archive too when they are asked for a range
+starting before it.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from attendance import rollups
+from attendance.models import Attendance, AttendanceArchive, Class, Marks, MarksArchive
+from attendance.report_cache import bump_versions
+
+# month (1-12) in which an academic year begins, the first term start month by default
+ACADEMIC_YEAR_START_MONTH = getattr(settings, 'ACADEMIC_YEAR_START_MONTH', rollups.TERM_START_MONTHS[0])
+
+BATCH_SIZE = 5000
+
+
+def academic_year_start(day):
+    """
+    returns the first day of the academic year containing day
+    """
+    if day.month >= ACADEMIC_YEAR_START_MONTH:
+        return datetime.date(day.year, ACADEMIC_YEAR_START_MONTH, 1)
+    return datetime.date(day.year - 1, ACADEMIC_YEAR_START_MONTH, 1)
+
+
+def live_from():
+    """
+    returns the first day of the current academic year, the only one the live views look at
+    """
+    return academic_year_start(timezone.now().date())
+
+
+def needs_archive(from_date):
+    """
+    returns True when a range starting on from_date (None for the live year) reaches into the archive
+    """
+    return from_date is not None and from_date < live_from()
+
+
+####################################################
+#           Moving                                 #
+####################################################
+
+
+def _move(live_list, archive_model, fields, batch_size):
+    """
+    Moves the rows of the live_list queryset into archive_model, batch_size rows per transaction.
+    returns the number of rows moved
+    """
+    moved = 0
+    while True:
+        with transaction.atomic():
+            ids = list(live_list.order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return moved
+            batch = live_list.model.objects.filter(id__in=ids)
+            archive_model.objects.bulk_create([archive_model(**row) for row in batch.values(*fields)])
+            batch.delete()
+        moved += len(ids)
+
+
+def archive_before(day, batch_size=BATCH_SIZE):
+    """
+    Moves the attendance before day, and the marks of the tests before day, to the archive.
+    returns (attendance rows moved, marks moved)
+    """
+    attendance_moved = _move(Attendance.objects.filter(date__lt=day), AttendanceArchive,
+                             ('student_id', 'date', 'is_present'), batch_size)
+    marks_moved = _move(Marks.objects.filter(test__date__lt=day), MarksArchive,
+                        ('student_id', 'test_id', 'marks'), batch_size)
+    if attendance_moved or marks_moved:
+        bump_versions(Class.objects.values_list('id', flat=True))
+    return attendance_moved, marks_moved
+
+
+####################################################
+#           Reading                                #
+####################################################
+
+
+def first_day(from_date=None):
+    """
+    returns the first day of the tests a report starting on from_date (None for the live year) covers :
+    from_date when it is before the live year, else the first day of the live year
+    """
+    if needs_archive(from_date):
+        return from_date
+    return live_from()
+
+
+def marks_lists(from_date=None, to_date=None, **filters):
+    """
+    returns the querysets of the marks matching filters of the tests from first_day(from_date) on, and up to
+    to_date when it is not None : the Marks, and the MarksArchive too when the range reaches into the archive
+    """
+    if to_date is not None:
+        filters['test__date__lte'] = to_date
+    mark_lists = [Marks.objects.filter(test__date__gte=first_day(from_date), **filters)]
+    if needs_archive(from_date):
+        mark_lists.append(MarksArchive.objects.filter(test__date__gte=from_date, **filters))
+    return mark_lists
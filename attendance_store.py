@@ -0,0 +1,337 @@
+"""
+Storage backends of the attendance.
+
+* RowStore keeps one Attendance row per student per day, with the rollups and prefix rows of attendance.rollups.
+* PackedStore keeps one PackedAttendance row per student per term : a bitset of the days attendance was
+  taken and a bitset of the days the student was present. Counts are popcounts over the bitsets.
+
+Both have the same methods, the one used is chosen by settings.ATTENDANCE_STORE ('rows', the default, or 'packed').
+"""
+import datetime
+from collections import defaultdict
+from itertools import chain
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import BinaryField, Case, Max, Value, When
+
+from attendance import rollups
+from attendance.models import Attendance, PackedAttendance
+
+
+def get_store():
+    """
+    returns the attendance store selected in the settings
+    """
+    if getattr(settings, 'ATTENDANCE_STORE', 'rows') == 'packed':
+        return PackedStore()
+    return RowStore()
+
+
+def _retry_on_integrity_error(function, *args):
+    try:
+        return function(*args)
+    except IntegrityError:
+        # a concurrent submission inserted some of the rows first, they are updated on the second try
+        return function(*args)
+
+
+class RowStore(object):
+    """
+    One Attendance row per student per day
+    """
+
+    def _save(self, student_ids, day, present_ids):
+        changes = []
+        with transaction.atomic():
+            existing = Attendance.objects.select_for_update().filter(student_id__in=student_ids, date=day)
+            existing = {attendance.student_id: attendance for attendance in existing}
+            new_rows = []
+            changed = {True: [], False: []}
+            for student_id in student_ids:
+                is_present = student_id in present_ids
+                attendance = existing.get(student_id)
+                if attendance is None:
+                    new_rows.append(Attendance(student_id=student_id, date=day, is_present=is_present))
+                    changes.append((student_id, day, int(is_present), 1))
+                elif attendance.is_present != is_present:
+                    changed[is_present].append(attendance.id)
+                    changes.append((student_id, day, int(is_present) - int(attendance.is_present), 0))
+            Attendance.objects.bulk_create(new_rows)
+            for is_present, ids in changed.items():
+                if ids:
+                    Attendance.objects.filter(id__in=ids).update(is_present=is_present)
+            rollups.apply_attendance_changes(changes)
+        return changes
+
+    def save(self, student_ids, day, present_ids):
+        """
+        Saves the attendance of day for the students in student_ids, those in present_ids being present.
+        returns the list of (student_id, day, present_change, total_change) that was applied
+        """
+        return _retry_on_integrity_error(self._save, student_ids, day, set(present_ids))
+
+    def day_list(self, student_list, day):
+        """
+        returns the Attendance of day of the students in student_list who have one, in the order of student_list
+        """
+        student_list = list(student_list)
+        attendance = {a.student_id: a for a in Attendance.objects.filter(
+            student_id__in=[student.id for student in student_list], date=day)}
+        day_list = []
+        for student in student_list:
+            if student.id in attendance:
+                attendance[student.id].student = student
+                day_list.append(attendance[student.id])
+        return day_list
+
+    def absent_ids(self, day):
+        """
+        returns the ids of the students absent on day, as a subquery to filter students with
+        """
+        return Attendance.objects.filter(date=day, is_present=False).values('student_id')
+
+    def count_complete(self, student_ids):
+        """
+        returns a dictionary of student id -> (present, total) over all the attendance taken so far
+        """
+        return rollups.count_complete(student_ids)
+
+    def count_from_to(self, student_ids, from_date, to_date):
+        """
+        returns a dictionary of student id -> (present, total) between from_date and to_date, both inclusive
+        """
+        return rollups.count_from_to(student_ids, from_date, to_date)
+
+    def absence_streak(self, student_id):
+        """
+        returns the number of school days the student has been absent since the last day present
+        """
+        attendance_list = Attendance.objects.filter(student_id=student_id)
+        last_present = attendance_list.filter(is_present=True).aggregate(day=Max('date'))['day']
+        if last_present is not None:
+            attendance_list = attendance_list.filter(date__gt=last_present)
+        return attendance_list.count()
+
+    def history(self, student_ids):
+        """
+        returns a dictionary of student id -> list of (date, is_present) of every day attendance was taken for the
+        student, newest first, for the students in student_ids who have attendance. Takes a single query.
+        """
+        history = defaultdict(list)
+        for student_id, date, is_present in Attendance.objects.filter(student_id__in=student_ids).order_by(
+                'student_id', '-date').values_list('student_id', 'date', 'is_present').iterator():
+            history[student_id].append((rollups.as_day(date), is_present))
+        return history
+
+
+####################################################
+#           Bitsets                                #
+####################################################
+
+
+def to_int(bits):
+    """
+    returns the integer of little endian bytes, as stored in a BinaryField
+    """
+    if not bits:
+        return 0
+    return int.from_bytes(bytes(bits), 'little')
+
+
+def to_bytes(value):
+    return value.to_bytes((value.bit_length() + 7) // 8, 'little')
+
+
+def popcount(value):
+    return bin(value).count('1')
+
+
+def day_bit(term_start, day):
+    """
+    returns the position of day in the bitsets of the term starting on term_start
+    """
+    return (day - term_start).days
+
+
+def range_mask(first, last):
+    """
+    returns the mask of the bits first to last, both inclusive
+    """
+    if last < first:
+        return 0
+    return ((1 << (last + 1)) - 1) ^ ((1 << max(first, 0)) - 1)
+
+
+class PackedStore(object):
+    """
+    One PackedAttendance row per student per term
+    """
+
+    def _save(self, student_ids, day, present_ids):
+        term_start = rollups.term_start(day)
+        bit = 1 << day_bit(term_start, day)
+        changes = []
+        with transaction.atomic():
+            existing = {packed.student_id: packed for packed in PackedAttendance.objects.select_for_update().filter(
+                student_id__in=student_ids, term_start=term_start)}
+            new_rows = []
+            changed = []
+            for student_id in student_ids:
+                is_present = student_id in present_ids
+                packed = existing.get(student_id)
+                taken = to_int(packed.taken) if packed is not None else 0
+                present = to_int(packed.present) if packed is not None else 0
+                new_present = present | bit if is_present else present & ~bit
+                if packed is None:
+                    new_rows.append(PackedAttendance(student_id=student_id, term_start=term_start,
+                                                     taken=to_bytes(bit), present=to_bytes(new_present)))
+                elif taken & bit == 0 or new_present != present:
+                    changed.append((packed.id, to_bytes(taken | bit), to_bytes(new_present)))
+                else:
+                    continue
+                changes.append((student_id, day, int(is_present) - int(present & bit != 0),
+                                int(taken & bit == 0)))
+            PackedAttendance.objects.bulk_create(new_rows)
+            if changed:
+                PackedAttendance.objects.filter(id__in=[packed_id for packed_id, _, _ in changed]).update(
+                    taken=Case(*[When(id=packed_id, then=Value(taken)) for packed_id, taken, _ in changed],
+                               output_field=BinaryField()),
+                    present=Case(*[When(id=packed_id, then=Value(present)) for packed_id, _, present in changed],
+                                 output_field=BinaryField()),
+                )
+        return changes
+
+    def save(self, student_ids, day, present_ids):
+        """
+        Saves the attendance of day for the students in student_ids, those in present_ids being present.
+        returns the list of (student_id, day, present_change, total_change) that was applied
+        """
+        return _retry_on_integrity_error(self._save, student_ids, day, set(present_ids))
+
+    def day_list(self, student_list, day):
+        """
+        returns unsaved Attendance objects of day for the students in student_list who have one,
+        in the order of student_list
+        """
+        student_list = list(student_list)
+        term_start = rollups.term_start(day)
+        bit = 1 << day_bit(term_start, day)
+        packed = {packed.student_id: packed for packed in PackedAttendance.objects.filter(
+            student_id__in=[student.id for student in student_list], term_start=term_start)}
+        day_list = []
+        for student in student_list:
+            if student.id in packed and to_int(packed[student.id].taken) & bit:
+                day_list.append(Attendance(student=student, date=day,
+                                           is_present=to_int(packed[student.id].present) & bit != 0))
+        return day_list
+
+    def absent_ids(self, day):
+        """
+        returns the list of the ids of the students absent on day
+        """
+        bit = 1 << day_bit(rollups.term_start(day), day)
+        return [student_id for student_id, taken, present in PackedAttendance.objects.filter(
+            term_start=rollups.term_start(day)).values_list('student_id', 'taken', 'present').iterator()
+            if to_int(taken) & bit and not to_int(present) & bit]
+
+    def count_complete(self, student_ids):
+        """
+        returns a dictionary of student id -> (present, total) over all the attendance taken so far
+        """
+        counts = defaultdict(lambda: [0, 0])
+        for student_id, taken, present in PackedAttendance.objects.filter(student_id__in=student_ids).values_list(
+                'student_id', 'taken', 'present'):
+            counts[student_id][0] += popcount(to_int(present))
+            counts[student_id][1] += popcount(to_int(taken))
+        return {student_id: tuple(count) for student_id, count in counts.items()}
+
+    def count_from_to(self, student_ids, from_date, to_date):
+        """
+        returns a dictionary of student id -> (present, total) between from_date and to_date, both inclusive
+        """
+        from_date = rollups.as_day(from_date)
+        to_date = rollups.as_day(to_date)
+        packed_list = PackedAttendance.objects.filter(student_id__in=student_ids, term_start__lte=to_date)
+        if from_date.year > 1:
+            # a blank from date is date.min, whose term would start in the year 0
+            packed_list = packed_list.filter(term_start__gte=rollups.term_start(from_date))
+        counts = defaultdict(lambda: [0, 0])
+        for student_id, term_start, taken, present in packed_list.values_list(
+                'student_id', 'term_start', 'taken', 'present'):
+            mask = range_mask(day_bit(term_start, from_date), day_bit(term_start, to_date))
+            counts[student_id][0] += popcount(to_int(present) & mask)
+            counts[student_id][1] += popcount(to_int(taken) & mask)
+        return {student_id: tuple(count) for student_id, count in counts.items()}
+
+    def absence_streak(self, student_id):
+        """
+        returns the number of school days the student has been absent since the last day present
+        """
+        streak = 0
+        for taken, present in PackedAttendance.objects.filter(student_id=student_id).order_by(
+                '-term_start').values_list('taken', 'present'):
+            taken = to_int(taken)
+            present = to_int(present)
+            if present:
+                # the days taken after the last day present
+                return streak + popcount(taken >> present.bit_length())
+            streak += popcount(taken)
+        return streak
+
+    def history(self, student_ids):
+        """
+        returns a dictionary of student id -> list of (date, is_present) of every day attendance was taken for the
+        student, newest first, for the students in student_ids who have attendance. Takes a single query.
+        """
+        history = defaultdict(list)
+        for student_id, term_start, taken, present in PackedAttendance.objects.filter(
+                student_id__in=student_ids).order_by('student_id', '-term_start').values_list(
+                'student_id', 'term_start', 'taken', 'present').iterator():
+            taken = to_int(taken)
+            present = to_int(present)
+            for position in range(taken.bit_length() - 1, -1, -1):
+                if taken >> position & 1:
+                    history[student_id].append((term_start + datetime.timedelta(days=position),
+                                                bool(present >> position & 1)))
+        return history
+
+
+####################################################
+#           Conversion                             #
+####################################################
+
+
+def pack_rows(*attendance_lists):
+    """
+    returns a dictionary of (student_id, term_start) -> [taken, present] bitsets of the given Attendance
+    (or AttendanceArchive) querysets
+    """
+    packed = defaultdict(lambda: [0, 0])
+    for student_id, date, is_present in chain.from_iterable(
+            attendance_list.values_list('student_id', 'date', 'is_present').iterator()
+            for attendance_list in attendance_lists):
+        day = rollups.as_day(date)
+        term_start = rollups.term_start(day)
+        bit = 1 << day_bit(term_start, day)
+        bits = packed[(student_id, term_start)]
+        bits[0] |= bit
+        if is_present:
+            bits[1] |= bit
+    return packed
+
+
+def unpack_rows(packed_list):
+    """
+    yields unsaved Attendance objects for every day taken in the given PackedAttendance queryset
+    """
+    for student_id, term_start, taken, present in packed_list.values_list(
+            'student_id', 'term_start', 'taken', 'present').iterator():
+        taken = to_int(taken)
+        present = to_int(present)
+        position = 0
+        while taken >> position:
+            if taken >> position & 1:
+                yield Attendance(student_id=student_id, date=term_start + datetime.timedelta(days=position),
+                                 is_present=bool(present >> position & 1))
+            position += 1
@@ -0,0 +1,103 @@
+"""
+Benchmark of the views on a generated school.
+
+Every view is driven through the Django test client, recording its wall time, number of queries
+and peak memory. Results are plain dictionaries, written as JSON by the benchmark_views command so
+that runs on different commits can be compared.
+"""
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import NoReverseMatch, reverse
+
+# (name, user to log in as, method, url name, function returning the data of the request from the school)
+SCENARIOS = [
+    ('principal_index', 'principal', 'post', 'principal_index',
+     lambda school: {'class': school['class_ids'][0]}),
+    ('teacher_report_class', 'teacher', 'post', 'teacher_report_class',
+     lambda school: {'subject': school['subject_ids'][0][0]}),
+    ('teacher_report_view_single', 'teacher', 'post', 'teacher_report_view_single',
+     lambda school: {'student': school['student_ids'][0][0]}),
+    ('student_index', 'student', 'get', 'student_index', None),
+    ('teacher_attendance_today', 'teacher', 'post', 'teacher_attendance_today',
+     lambda school: dict(('student_' + str(student_id), 'on') for student_id in school['student_ids'][0][1:])),
+    ('teacher_attendance_today (taken)', 'teacher', 'get', 'teacher_attendance_today', None),
+    ('teacher_attendance_edit', 'teacher', 'get', 'teacher_attendance_edit', None),
+    ('teacher_test_select', 'teacher', 'get', 'teacher_test_select', None),
+    ('teacher_test_edit', 'teacher', 'post', 'teacher_test_select',
+     lambda school: {'test': 'Test 1', 'edit': 'on'}),
+    ('teacher_test_add', 'teacher', 'get', 'teacher_test_add', None),
+    ('teacher_student_edit', 'teacher', 'get', 'teacher_student_edit', None),
+    ('principal_index (form)', 'principal', 'get', 'principal_index', None),
+]
+
+
+def get_clients(school):
+    """
+    returns a dictionary of logged in test clients for the principal, the first teacher and its first student
+    """
+    usernames = {
+        'principal': school['principal'],
+        'teacher': school['teachers'][0],
+        'student': school['students'][0][0],
+    }
+    clients = {}
+    for role, username in usernames.items():
+        clients[role] = Client()
+        clients[role].force_login(User.objects.get(username=username))
+    return clients
+
+
+def measure(client, method, url, data, repeat):
+    """
+    Requests url repeat times, returns a dictionary with the status code, the number of queries of a request,
+    the best and median wall time in milliseconds and the peak memory in KiB allocated by one more request
+    """
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            begin = time.perf_counter()
+            response = getattr(client, method)(url, data)
+            timings.append((time.perf_counter() - begin) * 1000)
+        # read now, the log is cleared by the next request
+        query_count = len(queries.captured_queries)
+    tracemalloc.start()
+    try:
+        getattr(client, method)(url, data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    timings.sort()
+    return {
+        'status': response.status_code,
+        'queries': query_count,
+        'best_ms': round(timings[0], 3),
+        'median_ms': round(timings[len(timings) // 2], 3),
+        'peak_kib': round(peak / 1024.0, 1),
+    }
+
+
+def run_benchmark(school, repeat=5, scenarios=SCENARIOS):
+    """
+    Runs every scenario on the school returned by school_generator.generate_school,
+    returns a dictionary of scenario name -> result of measure.
+    Scenarios whose url name is not in the urlconf, or whose view raises, are recorded with an 'error'.
+    """
+    clients = get_clients(school)
+    results = {}
+    for name, role, method, url_name, get_data in scenarios:
+        try:
+            url = reverse(url_name)
+        except NoReverseMatch:
+            results[name] = {'error': 'no url named ' + url_name}
+            continue
+        data = get_data(school) if get_data is not None else {}
+        try:
+            results[name] = measure(clients[role], method, url, data, repeat)
+        except Exception as e:
+            results[name] = {'error': repr(e)}
+    return results
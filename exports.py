@@ -0,0 +1,128 @@
+"""
+CSV exports of the class and school reports.
+
+Rows are written one by one into a StreamingHttpResponse. The students are read from a .iterator() query in
+chunks of CHUNK_SIZE, and only the attendance counts and marks of the current chunk are in memory,
+so a whole school export uses the same memory as the export of a single class.
+"""
+import csv
+from itertools import chain, groupby
+
+from django.http import StreamingHttpResponse
+
+from attendance import archive
+from attendance.attendance_store import get_store
+from attendance.helper import _attendance_details
+from attendance.models import Student, Test
+
+CHUNK_SIZE = 500
+
+ATTENDANCE_HEADER = ['Present', 'Absent', 'Total', 'Percentage present']
+
+
+class Echo(object):
+    """
+    File like object handing back what csv.writer writes, so every row can be yielded as it is written
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_response(rows, filename):
+    """
+    returns a StreamingHttpResponse downloading the rows, an iterable of lists, as a CSV file
+    """
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
+    return response
+
+
+def student_chunks(student_list):
+    """
+    yields lists of at most CHUNK_SIZE students of the given Student queryset, read with a single iterator
+    """
+    chunk = []
+    for student in student_list.iterator():
+        chunk.append(student)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def count_attendance(student_ids, from_date=None, to_date=None):
+    """
+    returns a dictionary of student id -> (present, total), over all the attendance when from_date is None
+    """
+    if from_date is None:
+        return get_store().count_complete(student_ids)
+    return get_store().count_from_to(student_ids, from_date, to_date)
+
+
+def attendance_columns(present, total):
+    details = _attendance_details(present, total)
+    return [details['present'], details['absent'], details['total'], details['percentage_present']]
+
+
+def class_report_rows(class_id, subject, from_date=None, to_date=None):
+    """
+    yields the rows of the class report of a subject : a header, then one row per student with the marks of
+    every test of the subject from archive.first_day(from_date) on, up to to_date when it is not None, and the
+    attendance, only between from_date and to_date when they are not None
+    """
+    test_list = Test.objects.filter(subject=subject, date__gte=archive.first_day(from_date)).order_by('date', 'id')
+    if to_date is not None:
+        test_list = test_list.filter(date__lte=to_date)
+    test_list = list(test_list)
+    yield ['Roll no', 'Name'] + [test.name for test in test_list] + ATTENDANCE_HEADER
+    column_of = {test.id: column for column, test in enumerate(test_list)}
+    student_list = Student.objects.filter(which_class_id=class_id).order_by('roll_no', 'id')
+    for chunk in student_chunks(student_list):
+        student_ids = [student.id for student in chunk]
+        counts = count_attendance(student_ids, from_date, to_date)
+        marks_of = {}
+        for student_id, test_id, marks in chain.from_iterable(
+                mark_list.values_list('student_id', 'test_id', 'marks')
+                for mark_list in archive.marks_lists(from_date, to_date, student_id__in=student_ids,
+                                                     test__subject=subject)):
+            marks_of.setdefault(student_id, [''] * len(test_list))[column_of[test_id]] = marks
+        for student in chunk:
+            yield [student.roll_no, student.name] + marks_of.get(student.id, [''] * len(test_list)) + \
+                attendance_columns(*counts.get(student.id, (0, 0)))
+
+
+def school_report_rows(class_id=None, from_date=None, to_date=None):
+    """
+    yields the rows of the marks of the whole school, or of one class : a header, then one row per mark with the
+    class, the student, the test and the attendance of the student.
+    Students without marks get one row with the attendance only.
+    The marks are those of the live year when from_date and to_date are None, else those of the tests between
+    from_date and to_date (with the archived ones), and the attendance is only counted between them.
+    """
+    yield ['Class', 'Roll no', 'Name', 'Subject', 'Test', 'Date', 'Marks', 'Total marks'] + ATTENDANCE_HEADER
+    student_list = Student.objects.select_related('which_class').order_by(
+        'which_class__grade', 'which_class__division', 'which_class_id', 'roll_no', 'id')
+    if class_id is not None:
+        student_list = student_list.filter(which_class_id=class_id)
+    for chunk in student_chunks(student_list):
+        student_ids = [student.id for student in chunk]
+        counts = count_attendance(student_ids, from_date, to_date)
+        marks_of = {}
+        for mark_list in archive.marks_lists(from_date, to_date, student_id__in=student_ids):
+            mark_list = mark_list.order_by('student_id', 'test__subject__name', 'test__date', 'test_id').values_list(
+                'student_id', 'test__subject__name', 'test__name', 'test__date', 'marks', 'test__total_marks')
+            for student_id, rows in groupby(mark_list.iterator(), key=lambda row: row[0]):
+                marks_of.setdefault(student_id, []).extend(rows)
+        for rows in marks_of.values():
+            # the archived marks come after the live ones
+            rows.sort(key=lambda row: (row[1], row[3]))
+        for student in chunk:
+            attendance = attendance_columns(*counts.get(student.id, (0, 0)))
+            student_columns = [str(student.which_class), student.roll_no, student.name]
+            for _, subject_name, test_name, date, marks, total_marks in marks_of.get(student.id, []):
+                yield student_columns + [subject_name, test_name, date, marks, total_marks] + attendance
+            if student.id not in marks_of:
+                yield student_columns + [''] * 5 + attendance
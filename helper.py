@@ -6,29 +6,52 @@ Any enquiries regarding code, email at sidhin.thomas@gmail.com
 Copyright 2016 Shift2Cloud Technologies
 """
 
+import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Case, Value, When
 from django.shortcuts import render
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 
-from attendance.models import Attendance, Test, Marks
+from attendance import absence
+from attendance.attendance_store import get_store
+from attendance.models import ROLE_CACHE_ATTR, AbsenceTracker, Attendance, Student, Teacher, Test, Marks
+from attendance.report_cache import bump_versions
 
 """
 These functions are to check is a giving User is of which type
+The group names of the user are loaded once and kept on the user object, which lives as long as the request
 """
 
 
+def get_roles(user):
+    """
+    returns the set of names of the groups of user
+    """
+    try:
+        return getattr(user, ROLE_CACHE_ATTR)
+    except AttributeError:
+        roles = frozenset(user.groups.values_list('name', flat=True))
+        setattr(user, ROLE_CACHE_ATTR, roles)
+        return roles
+
+
 def is_teacher(user):
-    return user.groups.filter(name='Teacher').exists()
+    return 'Teacher' in get_roles(user)
 
 
 def is_student(user):
-    return user.groups.filter(name='Student').exists()
+    return 'Student' in get_roles(user)
 
 
 def is_admin(user):
-    return user.groups.filter(name='Admin').exists()
+    return 'Admin' in get_roles(user)
 
 
 def is_principal(user):
-    return user.groups.filter(name='Principal').exists()
+    return 'Principal' in get_roles(user)
 
 
 """
@@ -62,6 +85,25 @@ def get_error_context(request):
     return context
 
 
+def get_date_range(data):
+    """
+    returns (from_date, to_date) read from the from_date and to_date fields of a form, (None, None) if both are blank.
+    A blank from_date means from the beginning, a blank to_date means up to today.
+    Raises ValueError if a date is not a valid YYYY-MM-DD date, or if from_date is after to_date.
+    """
+    from_date = data.get('from_date', '')
+    to_date = data.get('to_date', '')
+    if from_date == '' and to_date == '':
+        return None, None
+    from_date = parse_date(from_date) if from_date != '' else datetime.date.min
+    to_date = parse_date(to_date) if to_date != '' else timezone.now().date()
+    if from_date is None or to_date is None:
+        raise ValueError
+    if from_date > to_date:
+        raise ValueError('{0} is after {1}'.format(from_date, to_date))
+    return from_date, to_date
+
+
 ########################################################
 #                   Decorators                         #
 ########################################################
@@ -81,9 +123,20 @@ def admin_login_required(function):
 
 
 def teacher_login_required(function):
+    """
+    Also attaches to the request the teacher (request.teacher), the teacher's class (request.which_class)
+    and its id (request.class_id), fetched with a single query
+    """
     def wrapper(request):
         if not is_teacher(request.user):
             return render(request, 'attendance/unauthorised.html')
+        try:
+            teacher = Teacher.objects.select_related('which_class').get(user_id=request.user.id)
+        except Teacher.DoesNotExist:
+            return render(request, 'attendance/unauthorised.html')
+        request.teacher = teacher
+        request.which_class = teacher.which_class
+        request.class_id = teacher.which_class_id
         return function(request)
 
     return wrapper
@@ -133,52 +186,152 @@ def mark_report_subject(student, subject):
     return mark_details
 
 
-def get_attendance_report_from_to(student, from_date, to_date):
+def _attendance_details(present, total):
     """
-    returns a dictionary containing the details of the student's attendance in given time range
+    returns the present/absent/total/percentage_present part of an attendance report
     """
-    attendance_list = Attendance.objects.filter(student=student, date__gte=from_date, date__lte=to_date)
-    present = 0
-    absent = 0
-    total = attendance_list.count()
-    for att in attendance_list:
-        if att.is_present:
-            present += 1
-        else:
-            absent += 1
     try:
         percentage_present = (float(present) / total) * 100
     except ZeroDivisionError:
-        percentage_present = 0
+        percentage_present = 0.0
     return {
         'present': present,
-        'absent': absent,
+        'absent': total - present,
         'total': total,
         'percentage_present': '{0:.2f}'.format(percentage_present)
     }
 
 
+def get_attendance_report_from_to(student, from_date, to_date):
+    """
+    returns a dictionary containing the details of the student's attendance in given time range
+    """
+    present, total = get_store().count_from_to([student.id], from_date, to_date).get(student.id, (0, 0))
+    return _attendance_details(present, total)
+
+
+def get_attendance_summary_from_to(student_list, from_date, to_date):
+    """
+    returns a list of dictionaries, one per student in student_list and in the same order,
+    each having the same keys as get_attendance_complete but counting only the attendance in given time range.
+    Takes a single query for the whole list.
+    """
+    student_list = list(student_list)
+    counts = get_store().count_from_to([student.id for student in student_list], from_date, to_date)
+    summary = []
+    for student in student_list:
+        details = _attendance_details(*counts.get(student.id, (0, 0)))
+        details['student'] = student
+        summary.append(details)
+    return summary
+
+
 def get_attendance_complete(student):
     """
         returns a dictionary containing the details of the student's attendance so far
         """
-    attendance_list = Attendance.objects.filter(student=student)
-    present = 0
-    absent = 0
-    total = attendance_list.count()
-    for att in attendance_list:
-        if att.is_present:
-            present += 1
-        else:
-            absent += 1
+    return get_attendance_summary([student])[0]
+
+
+def get_attendance_summary(student_list):
+    """
+    returns a list of dictionaries, one per student in student_list and in the same order,
+    each having the same keys as get_attendance_complete.
+    All the counting is done by a single query on the attendance store.
+    """
+    student_list = list(student_list)
+    counts = get_store().count_complete([student.id for student in student_list])
+    summary = []
+    for student in student_list:
+        details = _attendance_details(*counts.get(student.id, (0, 0)))
+        details['student'] = student
+        summary.append(details)
+    return summary
+
+
+####################################################
+#           Attendance Writers                     #
+####################################################
+
+
+def save_attendance(student_ids, day, present_ids, class_ids=None):
+    """
+    Saves the attendance of day for the students in student_ids, those in present_ids being present,
+    in the attendance store selected in the settings, and moves the absence trackers of the students.
+    class_ids are the classes of the students, looked up when not given.
+    Saving the same attendance again changes nothing.
+    returns the list of (student_id, day, present_change, total_change) that was applied
+    """
+    with transaction.atomic():
+        changes = get_store().save(student_ids, day, present_ids)
+        bulk_update(AbsenceTracker, absence.track_changes(changes))
+    if changes:
+        if class_ids is None:
+            class_ids = Student.objects.filter(id__in=[student_id for student_id, _, _, _ in changes]).values_list(
+                'which_class_id', flat=True).distinct()
+        bump_versions(class_ids)
+    return changes
+
+
+def get_attendance_of_day(student_list, day):
+    """
+    returns the Attendance of day of the students in student_list who have one, in the order of student_list
+    """
+    return get_store().day_list(student_list, day)
+
+
+####################################################
+#           Bulk Writers                           #
+####################################################
+
+
+# query parameters per UPDATE of bulk_update, below the SQLite limit of 999
+BULK_UPDATE_MAX_PARAMS = 900
+
+
+def bulk_update(model, new_values):
+    """
+    Writes new_values, a dictionary of id -> dictionary of field name -> value, with one UPDATE ... CASE
+    per batch of rows. Every row has to give the same fields. Only pass the rows that changed, this sends no signals.
+    """
+    rows = list(new_values.items())
+    if not rows:
+        return
+    fields = list(rows[0][1])
+    # every row takes one parameter in the WHERE and two per field in the CASEs
+    batch_size = max(1, BULK_UPDATE_MAX_PARAMS // (1 + 2 * len(fields)))
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        model.objects.filter(id__in=[row_id for row_id, _ in batch]).update(**{
+            field: Case(*[When(id=row_id, then=Value(values[field])) for row_id, values in batch],
+                        output_field=model._meta.get_field(field))
+            for field in fields
+        })
+
+
+def parse_marks(value, total_marks):
+    """
+    returns the Decimal of a submitted mark, raises ValueError when it is not a number, is not between 0 and
+    total_marks or does not fit in Marks.marks
+    """
     try:
-        percentage_present = (float(present) / total) * 100
-    except ZeroDivisionError:
-        percentage_present = 0.0
-    return {
-        'student': student,
-        'present': present,
-        'absent': absent,
-        'total': total,
-        'percentage_present': '{0:.2f}'.format(percentage_present,)
-    }
+        marks = Decimal(value)
+    except InvalidOperation:
+        raise ValueError('{0} is not a number'.format(value))
+    if not marks.is_finite():
+        raise ValueError('{0} is not a number'.format(value))
+    if marks < 0 or marks > total_marks:
+        raise ValueError('{0} is not between 0 and {1}'.format(value, total_marks))
+    field = Marks._meta.get_field('marks')
+    _, digits, exponent = marks.normalize().as_tuple()
+    if -exponent > field.decimal_places or len(digits) + exponent > field.max_digits - field.decimal_places:
+        raise ValueError('{0} does not fit in {1} digits with {2} decimals'.format(
+            value, field.max_digits, field.decimal_places))
+    return marks
+
+
+def update_marks(new_marks):
+    """
+    Writes new_marks, a dictionary of Marks id -> marks, see bulk_update
+    """
+    bulk_update(Marks, {mark_id: {'marks': marks} for mark_id, marks in new_marks.items()})
@@ -0,0 +1,50 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from attendance import benchmark, school_generator
+
+
+class Command(BaseCommand):
+    help = 'Generates a school in a test database and writes the wall time, query count and peak memory ' \
+           'of every view as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--classes', type=int, default=2)
+        parser.add_argument('--students', type=int, default=60, help='Students per class')
+        parser.add_argument('--subjects', type=int, default=6, help='Subjects per class')
+        parser.add_argument('--tests', type=int, default=8, help='Tests per subject')
+        parser.add_argument('--days', type=int, default=200, help='School days of attendance')
+        parser.add_argument('--repeat', type=int, default=5, help='Requests per view')
+        parser.add_argument('--label', default='', help='Stored with the results, for example the commit')
+        parser.add_argument('--output', help='File to write the JSON to, instead of the standard output')
+
+    def handle(self, *args, **options):
+        sizes = dict((key, options[key]) for key in ('seed', 'classes', 'students', 'subjects', 'tests', 'days'))
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            begin = time.perf_counter()
+            school = school_generator.generate_school(**sizes)
+            generate_seconds = time.perf_counter() - begin
+            views = benchmark.run_benchmark(school, repeat=options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        results = json.dumps({
+            'label': options['label'],
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'school': sizes,
+            'generate_seconds': round(generate_seconds, 3),
+            'views': views,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(results + '\n')
+        else:
+            self.stdout.write(results)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from attendance import archive
+
+
+class Command(BaseCommand):
+    help = 'Moves the attendance and the marks of the past academic years out of the live tables, ' \
+           'into AttendanceArchive and MarksArchive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', help='Archive everything before this date (YYYY-MM-DD), '
+                                             'by default the first day of the current academic year')
+        parser.add_argument('--batch-size', type=int, default=archive.BATCH_SIZE,
+                            help='Rows moved per transaction')
+
+    def handle(self, *args, **options):
+        if options['before'] is None:
+            before = archive.live_from()
+        else:
+            try:
+                before = parse_date(options['before'])
+            except ValueError:
+                before = None
+            if before is None:
+                raise CommandError('--before is not a valid YYYY-MM-DD date')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size has to be at least 1')
+        attendance_moved, marks_moved = archive.archive_before(before, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Archived {0} attendance rows and {1} marks from before {2}'.format(
+            attendance_moved, marks_moved, before)))
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from attendance import attendance_store, report_cache, rollups
+from attendance.models import Attendance, AttendanceArchive, AttendancePrefix, AttendanceRollup, Class, \
+    PackedAttendance
+
+
+class Command(BaseCommand):
+    help = 'Converts the attendance between the Attendance rows and the packed bitsets of PackedAttendance. ' \
+           'Set ATTENDANCE_STORE in the settings to the converted store afterwards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=('packed', 'rows'),
+                            help='The store to convert to, its current content is replaced')
+        parser.add_argument('--check', action='store_true',
+                            help='Only check that both stores hold the same attendance, do not convert')
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            if options['to'] is None:
+                raise CommandError('Give the store to convert to with --to, or --check')
+            with transaction.atomic():
+                if options['to'] == 'packed':
+                    self.to_packed()
+                else:
+                    self.to_rows()
+                report_cache.bump_versions(Class.objects.values_list('id', flat=True))
+
+        packed = attendance_store.pack_rows(Attendance.objects.all(), AttendanceArchive.objects.all())
+        stored = {}
+        for student_id, term_start, taken, present in PackedAttendance.objects.values_list(
+                'student_id', 'term_start', 'taken', 'present').iterator():
+            stored[(student_id, term_start)] = [attendance_store.to_int(taken), attendance_store.to_int(present)]
+        mismatches = sorted(key for key in set(packed) | set(stored) if packed.get(key) != stored.get(key))
+        for student_id, term_start in mismatches:
+            self.stdout.write('student {0} term of {1}: the packed bitsets do not match the attendance rows'.format(
+                student_id, term_start))
+        if mismatches:
+            raise CommandError('{0} packed terms do not match the attendance rows'.format(len(mismatches)))
+        self.stdout.write(self.style.SUCCESS('The packed bitsets match the attendance rows'))
+
+    def to_packed(self):
+        packed = attendance_store.pack_rows(Attendance.objects.all(), AttendanceArchive.objects.all())
+        PackedAttendance.objects.all().delete()
+        PackedAttendance.objects.bulk_create([
+            PackedAttendance(student_id=student_id, term_start=term_start, taken=attendance_store.to_bytes(taken),
+                             present=attendance_store.to_bytes(present))
+            for (student_id, term_start), (taken, present) in packed.items()
+        ], batch_size=1000)
+        self.stdout.write('Packed the attendance into {0} terms'.format(len(packed)))
+
+    def to_rows(self):
+        # the packed bitsets hold the archived years too, they are all unpacked into the live table,
+        # close_academic_year archives them again
+        Attendance.objects.all().delete()
+        AttendanceArchive.objects.all().delete()
+        Attendance.objects.bulk_create(attendance_store.unpack_rows(PackedAttendance.objects.all()),
+                                       batch_size=1000)
+        # the rollups and prefix rows are only kept for the row store
+        expected = rollups.compute_rollups(Attendance.objects.all())
+        AttendanceRollup.objects.all().delete()
+        AttendanceRollup.objects.bulk_create([
+            AttendanceRollup(student_id=student_id, period=period, start=start, present=present, total=total)
+            for (student_id, period, start), (present, total) in expected.items()
+        ], batch_size=1000)
+        expected_prefixes = rollups.compute_prefixes(Attendance.objects.all())
+        AttendancePrefix.objects.all().delete()
+        AttendancePrefix.objects.bulk_create([
+            AttendancePrefix(student_id=student_id, date=date, ordinal=ordinal, present=present, total=total)
+            for (student_id, date), (ordinal, present, total) in expected_prefixes.items()
+        ], batch_size=1000)
+        self.stdout.write('Unpacked the attendance into {0} rows'.format(Attendance.objects.count()))
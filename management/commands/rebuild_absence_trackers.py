@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from attendance import absence
+from attendance.models import AbsenceTracker, Student
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the absence trackers of all the students from the attendance store, ' \
+           'for the attendance saved before they were kept'
+
+    def handle(self, *args, **options):
+        trackers = absence.build_trackers(Student.objects.values_list('id', flat=True).iterator())
+        with transaction.atomic():
+            AbsenceTracker.objects.all().delete()
+            AbsenceTracker.objects.bulk_create(trackers, batch_size=1000)
+        self.stdout.write(self.style.SUCCESS('Rebuilt {0} absence trackers, {1} students at risk'.format(
+            len(trackers), sum(1 for tracker in trackers if tracker.at_risk))))
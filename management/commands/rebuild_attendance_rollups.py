@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from attendance import report_cache, rollups
+from attendance.models import Attendance, AttendanceArchive, AttendancePrefix, AttendanceRollup, Class
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the attendance rollups and prefix rows from the raw Attendance rows ' \
+           'and checks them against the raw rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only check the stored rollups against the raw rows, do not rebuild them')
+
+    def handle(self, *args, **options):
+        expected = rollups.compute_rollups(Attendance.objects.all(), AttendanceArchive.objects.all())
+        expected_prefixes = rollups.compute_prefixes(Attendance.objects.all(), AttendanceArchive.objects.all())
+        if not options['check']:
+            with transaction.atomic():
+                AttendanceRollup.objects.all().delete()
+                AttendanceRollup.objects.bulk_create([
+                    AttendanceRollup(student_id=student_id, period=period, start=start,
+                                     present=present, total=total)
+                    for (student_id, period, start), (present, total) in expected.items()
+                ], batch_size=1000)
+                AttendancePrefix.objects.all().delete()
+                AttendancePrefix.objects.bulk_create([
+                    AttendancePrefix(student_id=student_id, date=date, ordinal=ordinal,
+                                     present=present, total=total)
+                    for (student_id, date), (ordinal, present, total) in expected_prefixes.items()
+                ], batch_size=1000)
+                report_cache.bump_versions(Class.objects.values_list('id', flat=True))
+            self.stdout.write('Rebuilt {0} rollup buckets and {1} prefix rows'.format(
+                len(expected), len(expected_prefixes)))
+
+        mismatches = rollups.compare_rollups(expected)
+        for student_id, period, start, stored, counted in mismatches:
+            self.stdout.write('student {0} {1} {2}: stored (present, total) {3}, raw rows give {4}'.format(
+                student_id, period, start, stored, counted))
+        prefix_mismatches = rollups.compare_prefixes(expected_prefixes)
+        for student_id, date, stored, counted in prefix_mismatches:
+            self.stdout.write('student {0} {1}: stored (ordinal, present, total) {2}, raw rows give {3}'.format(
+                student_id, date, stored, counted))
+        if mismatches or prefix_mismatches:
+            raise CommandError('{0} rollup buckets and {1} prefix rows do not match the attendance rows'.format(
+                len(mismatches), len(prefix_mismatches)))
+        self.stdout.write(self.style.SUCCESS('Rollups match the attendance rows'))
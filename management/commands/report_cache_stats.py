@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from attendance import report_cache
+
+
+class Command(BaseCommand):
+    help = 'Shows the hits and misses of the report cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Start counting again from zero')
+
+    def handle(self, *args, **options):
+        stats = report_cache.get_stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = float(stats['hits']) / lookups * 100 if lookups else 0.0
+        self.stdout.write('{0} hits, {1} misses, {2:.1f}% hit rate'.format(stats['hits'], stats['misses'], hit_rate))
+        if options['reset']:
+            report_cache.reset_stats()
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from attendance import sms_sender
+
+
+class Command(BaseCommand):
+    help = 'Sends the SMS and emails in the outbox, in batches, retrying failed ones with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Stop when the outbox has nothing due instead of waiting for new messages')
+        parser.add_argument('--batch-size', type=int, default=sms_sender.BATCH_SIZE)
+        parser.add_argument('--concurrency', type=int, default=sms_sender.CONCURRENCY)
+        parser.add_argument('--timeout', type=float, default=sms_sender.TIMEOUT,
+                            help='Seconds to wait for the gateway on each message')
+        parser.add_argument('--poll', type=float, default=5,
+                            help='Seconds to wait when there is nothing to send')
+
+    def handle(self, *args, **options):
+        while True:
+            report = sms_sender.process_outbox(batch_size=options['batch_size'],
+                                               concurrency=options['concurrency'],
+                                               timeout=options['timeout'])
+            if report.sent or report.failed:
+                self.stdout.write(str(report))
+                continue
+            if options['once']:
+                return
+            time.sleep(options['poll'])
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    First step of turning the date and time of the attendance into a date, the day column is filled by the
+    next migration
+    """
+
+    dependencies = [
+        ('attendance', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attendance',
+            name='date',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='attendance',
+            name='day',
+            field=models.DateField(null=True),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations
+from django.utils import timezone
+
+# rows updated or deleted per query
+BATCH_SIZE = 500
+
+
+def dates_to_days(apps, schema_editor):
+    """
+    Sets the day of every attendance to the local date of its date and time, in the TIME_ZONE of the settings.
+    A student has one attendance per day from now on, of the rows of the same day the last saved one is kept.
+    """
+    Attendance = apps.get_model('attendance', 'Attendance')
+    attendance_list = Attendance.objects.using(schema_editor.connection.alias)
+    kept = {}
+    duplicate_ids = []
+    for attendance_id, student_id, date in attendance_list.order_by('id').values_list(
+            'id', 'student_id', 'date').iterator():
+        if timezone.is_aware(date):
+            date = timezone.localtime(date)
+        key = (student_id, date.date())
+        if key in kept:
+            duplicate_ids.append(kept[key])
+        kept[key] = attendance_id
+    for start in range(0, len(duplicate_ids), BATCH_SIZE):
+        attendance_list.filter(id__in=duplicate_ids[start:start + BATCH_SIZE]).delete()
+    ids_of_day = {}
+    for (_, day), attendance_id in kept.items():
+        ids_of_day.setdefault(day, []).append(attendance_id)
+    for day, ids in ids_of_day.items():
+        for start in range(0, len(ids), BATCH_SIZE):
+            attendance_list.filter(id__in=ids[start:start + BATCH_SIZE]).update(day=day)
+
+
+def days_to_dates(apps, schema_editor):
+    """
+    Sets the date and time of every attendance to the local midnight of its day, the merged rows are not restored
+    """
+    Attendance = apps.get_model('attendance', 'Attendance')
+    attendance_list = Attendance.objects.using(schema_editor.connection.alias)
+    for day in attendance_list.values_list('day', flat=True).distinct():
+        date = datetime.datetime.combine(day, datetime.time())
+        if settings.USE_TZ:
+            date = timezone.make_aware(date)
+        attendance_list.filter(day=day).update(date=date)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0002_attendance_day'),
+    ]
+
+    operations = [
+        migrations.RunPython(dates_to_days, days_to_dates),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Replaces the date and time of the attendance by the day filled by the previous migration,
+    a student having one attendance per day
+    """
+
+    dependencies = [
+        ('attendance', '0003_attendance_local_days'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='attendance',
+            name='date',
+        ),
+        migrations.RenameField(
+            model_name='attendance',
+            old_name='day',
+            new_name='date',
+        ),
+        migrations.AlterField(
+            model_name='attendance',
+            name='date',
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='attendance',
+            unique_together=set([('student', 'date')]),
+        ),
+    ]
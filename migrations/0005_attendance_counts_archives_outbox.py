@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 09:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0004_attendance_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AbsenceTracker',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_day', models.DateField()),
+                ('streak', models.IntegerField(default=0)),
+                ('streak_before', models.IntegerField(default=0)),
+                ('window', models.BigIntegerField(default=0)),
+                ('window_days', models.IntegerField(default=0)),
+                ('at_risk', models.BooleanField(db_index=True, default=False)),
+                ('student', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='attendance.Student')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AttendanceArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('is_present', models.BooleanField(default=True)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='attendance.Student')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AttendancePrefix',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ordinal', models.IntegerField()),
+                ('date', models.DateField()),
+                ('present', models.IntegerField()),
+                ('total', models.IntegerField()),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='attendance.Student')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AttendanceRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('D', 'Day'), ('M', 'Month'), ('T', 'Term')], max_length=1)),
+                ('start', models.DateField()),
+                ('present', models.IntegerField(default=0)),
+                ('total', models.IntegerField(default=0)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='attendance.Student')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MarksArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('marks', models.DecimalField(decimal_places=2, max_digits=7)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='attendance.Student')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('sms', 'SMS'), ('email', 'Email')], default='sms', max_length=5)),
+                ('recipient', models.CharField(max_length=100)),
+                ('date', models.DateField()),
+                ('sequence', models.IntegerField(default=0)),
+                ('student_ids', models.TextField(blank=True, default='')),
+                ('subject', models.CharField(blank=True, default='', max_length=200)),
+                ('message', models.TextField()),
+                ('status', models.CharField(choices=[('Q', 'Queued'), ('S', 'In flight'), ('D', 'Sent'), ('F', 'Failed')], default='Q', max_length=1)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('sent_at', models.DateTimeField(default=None, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PackedAttendance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term_start', models.DateField()),
+                ('taken', models.BinaryField()),
+                ('present', models.BinaryField()),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='attendance.Student')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='marks',
+            index_together=set([('test', 'student'), ('student', 'test')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='test',
+            index_together=set([('subject', 'date'), ('subject', 'name')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='outboxmessage',
+            unique_together=set([('channel', 'recipient', 'date', 'sequence')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='outboxmessage',
+            index_together=set([('status', 'next_attempt')]),
+        ),
+        migrations.AddField(
+            model_name='marksarchive',
+            name='test',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='attendance.Test'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='packedattendance',
+            unique_together=set([('student', 'term_start')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='marksarchive',
+            index_together=set([('test', 'student'), ('student', 'test')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='attendancerollup',
+            unique_together=set([('student', 'period', 'start')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='attendanceprefix',
+            unique_together=set([('student', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='attendanceprefix',
+            index_together=set([('student', 'ordinal')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='attendancearchive',
+            unique_together=set([('student', 'date')]),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations
+
+from attendance import absence, attendance_store, rollups
+
+
+class HistoricalRowStore(object):
+    """
+    The history of attendance.attendance_store.RowStore over the Attendance rows of the migration
+    """
+
+    def __init__(self, attendance_list):
+        self.attendance_list = attendance_list
+
+    def history(self, student_ids):
+        history = defaultdict(list)
+        for student_id, date, is_present in self.attendance_list.filter(student_id__in=student_ids).order_by(
+                'student_id', '-date').values_list('student_id', 'date', 'is_present').iterator():
+            history[student_id].append((date, is_present))
+        return history
+
+
+def fill_counts(apps, schema_editor):
+    """
+    Counts the existing attendance into the rollups, prefix rows, packed bitsets and absence trackers,
+    as the rebuild_attendance_rollups, convert_attendance_store and rebuild_absence_trackers commands do
+    """
+    database = schema_editor.connection.alias
+    models = {name: apps.get_model('attendance', name).objects.using(database) for name in (
+        'Attendance', 'AttendanceRollup', 'AttendancePrefix', 'PackedAttendance', 'AbsenceTracker', 'Student')}
+    attendance_list = models['Attendance'].all()
+    models['AttendanceRollup'].bulk_create([
+        models['AttendanceRollup'].model(student_id=student_id, period=period, start=start, present=present,
+                                         total=total)
+        for (student_id, period, start), (present, total) in rollups.compute_rollups(attendance_list).items()
+    ], batch_size=1000)
+    models['AttendancePrefix'].bulk_create([
+        models['AttendancePrefix'].model(student_id=student_id, date=date, ordinal=ordinal, present=present,
+                                         total=total)
+        for (student_id, date), (ordinal, present, total) in rollups.compute_prefixes(attendance_list).items()
+    ], batch_size=1000)
+    models['PackedAttendance'].bulk_create([
+        models['PackedAttendance'].model(student_id=student_id, term_start=term_start,
+                                         taken=attendance_store.to_bytes(taken),
+                                         present=attendance_store.to_bytes(present))
+        for (student_id, term_start), (taken, present) in attendance_store.pack_rows(attendance_list).items()
+    ], batch_size=1000)
+    trackers = absence.build_trackers(models['Student'].values_list('id', flat=True).iterator(),
+                                      HistoricalRowStore(attendance_list))
+    models['AbsenceTracker'].bulk_create([
+        models['AbsenceTracker'].model(student_id=tracker.student_id,
+                                       **{field: getattr(tracker, field) for field in absence.FIELDS})
+        for tracker in trackers
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0005_attendance_counts_archives_outbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_counts, migrations.RunPython.noop),
+    ]
@@ -2,10 +2,24 @@ from __future__ import unicode_literals
 
 from django.contrib.auth.models import User, Group
 from django.db import models
+from django.utils import timezone
 
 
 # Create your models here.
 
+# attribute of a User on which attendance.helper.get_roles keeps the names of its groups
+ROLE_CACHE_ATTR = '_role_names'
+
+
+def add_to_group(user, group_name):
+    """
+    Adds user to the group and drops the group names cached on it
+    """
+    user.groups.add(Group.objects.get(name=group_name))
+    if hasattr(user, ROLE_CACHE_ATTR):
+        delattr(user, ROLE_CACHE_ATTR)
+
+
 class Class(models.Model):
     grade = models.IntegerField()
     division = models.CharField(max_length=1)
@@ -21,7 +35,7 @@ class Teacher(models.Model):
 
     def set_user(self, user):
         self.user = user
-        self.user.groups.add(Group.objects.get(name='Teacher'))
+        add_to_group(self.user, 'Teacher')
 
     def remove(self):
         self.user.delete()
@@ -36,7 +50,7 @@ class Admin(models.Model):
 
     def set_user(self, user):
         self.user = user
-        self.user.groups.add(Group.objects.get(name='Admin'))
+        add_to_group(self.user, 'Admin')
 
     def remove(self):
         self.user.delete()
@@ -51,7 +65,7 @@ class Principal(models.Model):
 
     def set_user(self, user):
         self.user = user
-        self.user.groups.add(Group.objects.get(name='Principal'))
+        add_to_group(self.user, 'Principal')
 
     def remove(self):
         self.user.delete()
@@ -70,7 +84,7 @@ class Student(models.Model):
 
     def set_user(self, user):
         self.user = user
-        self.user.groups.add(Group.objects.get(name='Student'))
+        add_to_group(self.user, 'Student')
 
     def remove(self):
         self.user.delete()
@@ -88,10 +102,86 @@ class Parent(models.Model):
 
 
 class Attendance(models.Model):
-    date = models.DateTimeField()
+    date = models.DateField(db_index=True)
     student = models.ForeignKey(Student)
     is_present = models.BooleanField(default=True)
 
+    class Meta:
+        unique_together = ('student', 'date')
+
+
+class AttendanceRollup(models.Model):
+    """
+    Present and total counters of a student's attendance in one day, month or term bucket.
+    Kept up to date by attendance.rollups whenever Attendance rows are written.
+    """
+    DAY = 'D'
+    MONTH = 'M'
+    TERM = 'T'
+    PERIOD_CHOICES = (
+        (DAY, 'Day'),
+        (MONTH, 'Month'),
+        (TERM, 'Term'),
+    )
+
+    student = models.ForeignKey(Student)
+    period = models.CharField(max_length=1, choices=PERIOD_CHOICES)
+    start = models.DateField()
+    present = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('student', 'period', 'start')
+
+
+class AttendancePrefix(models.Model):
+    """
+    Running totals of a student's attendance from the first school day up to and including date,
+    which is the ordinal-th school day of the student.
+    The attendance between two dates is the difference of two of these rows.
+    """
+    student = models.ForeignKey(Student)
+    ordinal = models.IntegerField()
+    date = models.DateField()
+    present = models.IntegerField()
+    total = models.IntegerField()
+
+    class Meta:
+        unique_together = ('student', 'date')
+        index_together = ('student', 'ordinal')
+
+
+class PackedAttendance(models.Model):
+    """
+    A student's attendance of a whole term, used instead of the Attendance rows by the packed store.
+    Bit n of taken (little endian) is set when attendance was taken on the n-th day from term_start,
+    the same bit of present when the student was present that day.
+    """
+    student = models.ForeignKey(Student)
+    term_start = models.DateField()
+    taken = models.BinaryField()
+    present = models.BinaryField()
+
+    class Meta:
+        unique_together = ('student', 'term_start')
+
+
+class AbsenceTracker(models.Model):
+    """
+    Current absence streak of a student and attendance over the student's last school days,
+    kept up to date by attendance.absence whenever attendance is saved.
+    Bit n of window is set when the student was present on the n-th last day attendance was taken,
+    bit 0 being last_day.
+    """
+    student = models.OneToOneField(Student)
+    last_day = models.DateField()
+    streak = models.IntegerField(default=0)
+    # the streak before last_day, so last_day can be edited
+    streak_before = models.IntegerField(default=0)
+    window = models.BigIntegerField(default=0)
+    window_days = models.IntegerField(default=0)
+    at_risk = models.BooleanField(default=False, db_index=True)
+
 
 class Subject(models.Model):
     name = models.CharField(max_length=100)
@@ -104,12 +194,100 @@ class Test(models.Model):
     name = models.CharField(max_length=100, unique=False)
     date = models.DateField()
 
+    class Meta:
+        index_together = (
+            ('subject', 'name'),
+            ('subject', 'date'),
+        )
+
 
 class Marks(models.Model):
     marks = models.DecimalField(decimal_places=2, max_digits=7)
     test = models.ForeignKey(Test)
     student = models.ForeignKey(Student)
 
+    class Meta:
+        index_together = (
+            ('student', 'test'),
+            ('test', 'student'),
+        )
+
+
+class AttendanceArchive(models.Model):
+    """
+    Attendance of a past academic year, moved out of Attendance by the close_academic_year command
+    """
+    date = models.DateField()
+    student = models.ForeignKey(Student)
+    is_present = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = ('student', 'date')
+
+
+class MarksArchive(models.Model):
+    """
+    Marks of a test of a past academic year, moved out of Marks by the close_academic_year command
+    """
+    marks = models.DecimalField(decimal_places=2, max_digits=7)
+    test = models.ForeignKey(Test)
+    student = models.ForeignKey(Student)
+
+    class Meta:
+        index_together = (
+            ('student', 'test'),
+            ('test', 'student'),
+        )
+
+
+class OutboxMessage(models.Model):
+    """
+    A message waiting to be sent, or already sent, by the sms worker : an SMS to a phone number or an email.
+    The first message of a recipient for a day tells of the absences of all the children of a parent, the next ones
+    (sequence 1, 2...) only of the children marked absent after it was queued, so queueing the same day again sends
+    nothing new.
+    """
+    QUEUED = 'Q'
+    SENDING = 'S'
+    SENT = 'D'
+    FAILED = 'F'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (SENDING, 'In flight'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    SMS = 'sms'
+    EMAIL = 'email'
+    CHANNEL_CHOICES = (
+        (SMS, 'SMS'),
+        (EMAIL, 'Email'),
+    )
+
+    channel = models.CharField(max_length=5, choices=CHANNEL_CHOICES, default=SMS)
+    # phone number of an SMS, address of an email
+    recipient = models.CharField(max_length=100)
+    date = models.DateField()
+    sequence = models.IntegerField(default=0)
+    # ids of the students the message tells of, separated by commas
+    student_ids = models.TextField(blank=True, default='')
+    subject = models.CharField(max_length=200, blank=True, default='')
+    message = models.TextField()
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    # when a queued message is due, or when the claim of an in flight message runs out
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    sent_at = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        unique_together = ('channel', 'recipient', 'date', 'sequence')
+        index_together = ('status', 'next_attempt')
+
+
+# connects the signal receivers keeping the report cache up to date
+from attendance import report_cache  # noqa: E402
 
 # Experimental feature to be added
 '''
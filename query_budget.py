@@ -0,0 +1,205 @@
+"""
+Query counting with per view budgets, to catch ORM calls inside loops.
+
+Every query of a request is recorded with the place in the app that ran it. Queries are grouped by
+their SQL shape (the SQL with its values and IN lists taken out), so the same shape run again and again,
+the sign of an N+1 pattern, shows up with its call sites.
+
+* QueryBudgetMiddleware logs requests going over the budget of their url name, when DEBUG is on
+* assert_query_budget is the same check for tests, raising an AssertionError
+
+Budgets come from settings.QUERY_BUDGETS (url name -> number of queries), on top of DEFAULT_QUERY_BUDGETS.
+"""
+import logging
+import os
+import re
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.utils import CursorDebugWrapper
+
+logger = logging.getLogger('attendance.queries')
+
+# Query budgets of the views whose number of queries does not grow with the number of rows,
+# the most queries of a request measured with the report cache empty (see tests.QueryBudgetTests).
+# teacher_attendance_today is the first attendance of the day : 4 for the session, user, groups and teacher,
+# 1 for the students, then 2 each for the attendance rows (read, insert) and the absence trackers (read, update)
+# and 3 each for the rollups (read, insert the day, update) and the prefix rows (read, read the previous rows, insert)
+DEFAULT_QUERY_BUDGETS = {
+    'principal_index': 10,
+    'student_index': 7,
+    'teacher_report_view_single': 8,
+    'teacher_report_class': 9,
+    'teacher_attendance_today': 15,
+}
+
+# The same SQL shape run this many times in one request is reported as an N+1 pattern
+REPEAT_THRESHOLD = getattr(settings, 'QUERY_REPEAT_THRESHOLD', 3)
+
+# Statements of the transactions (and savepoints of atomic blocks), which are not counted as queries
+TRANSACTION_CONTROL = re.compile(r'^\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b', re.IGNORECASE)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+THIS_FILE = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+
+def get_budget(url_name):
+    """
+    returns the query budget of the url name, None if it has none
+    """
+    budgets = dict(DEFAULT_QUERY_BUDGETS)
+    budgets.update(getattr(settings, 'QUERY_BUDGETS', {}))
+    return budgets.get(url_name)
+
+
+def fingerprint(sql):
+    """
+    returns the shape of the sql : values and IN lists replaced by placeholders
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\((\s*(%s|\?)\s*,)*\s*(%s|\?)\s*\)', '(...)', sql)
+    return sql
+
+
+def call_site():
+    """
+    returns 'file:line in function' of the innermost frame of the app outside this module
+    """
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame[0])
+        if filename.startswith(APP_DIR) and filename != THIS_FILE:
+            return '{0}:{1} in {2}'.format(os.path.relpath(filename, APP_DIR), frame[1], frame[2])
+    return 'outside the app'
+
+
+class QueryRecorder(object):
+    """
+    Context manager recording the (sql, call site) of every query run inside it, on every database,
+    leaving out the transaction control statements.
+    Recorders can be nested, the outer ones see the queries of the inner ones too.
+    """
+
+    def __init__(self):
+        self.queries = []
+        # connection alias -> recorder this one is nested in on that connection
+        self.parents = {}
+        self._saved = []
+
+    def record(self, sql):
+        if not TRANSACTION_CONTROL.match(sql):
+            self.queries.append((sql, call_site()))
+
+    def __enter__(self):
+        for connection in connections.all():
+            self.parents[connection.alias] = connection.__dict__.get('query_recorder')
+            self._saved.append((connection, connection.force_debug_cursor,
+                                connection.__dict__.get('make_debug_cursor'), self.parents[connection.alias]))
+            connection.force_debug_cursor = True
+            connection.query_recorder = self
+            connection.make_debug_cursor = lambda cursor, connection=connection: RecordingCursor(cursor, connection)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for connection, force_debug_cursor, make_debug_cursor, query_recorder in self._saved:
+            connection.force_debug_cursor = force_debug_cursor
+            for name, value in (('make_debug_cursor', make_debug_cursor), ('query_recorder', query_recorder)):
+                if value is None:
+                    del connection.__dict__[name]
+                else:
+                    connection.__dict__[name] = value
+        self._saved = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """
+        returns an ordered dictionary of SQL shape -> list of call sites, for the shapes run at least threshold times
+        """
+        shapes = OrderedDict()
+        for sql, site in self.queries:
+            shapes.setdefault(fingerprint(sql), []).append(site)
+        return OrderedDict((shape, sites) for shape, sites in shapes.items() if len(sites) >= threshold)
+
+    def report(self):
+        """
+        returns a readable description of the repeated queries and where they come from
+        """
+        lines = ['{0} queries'.format(len(self.queries))]
+        for shape, sites in self.repeated().items():
+            lines.append('{0} times : {1}'.format(len(sites), shape))
+            for site in sorted(set(sites)):
+                lines.append('    from ' + site)
+        return '\n'.join(lines)
+
+
+class RecordingCursor(CursorDebugWrapper):
+    """
+    Debug cursor also handing every query to the recorders of its connection
+    """
+
+    def _record(self, sql):
+        recorder = self.db.__dict__.get('query_recorder')
+        while recorder is not None:
+            recorder.record(sql)
+            recorder = recorder.parents.get(self.db.alias)
+
+    def execute(self, sql, params=None):
+        try:
+            return super(RecordingCursor, self).execute(sql, params)
+        finally:
+            self._record(sql)
+
+    def executemany(self, sql, param_list):
+        try:
+            return super(RecordingCursor, self).executemany(sql, param_list)
+        finally:
+            self._record(sql)
+
+
+class QueryBudgetMiddleware(object):
+    """
+    Development middleware logging the requests that run more queries than the budget of their url name,
+    and the N+1 patterns of every request, with their call sites
+    """
+
+    def __init__(self, get_response):
+        if not settings.DEBUG:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        budget = get_budget(url_name)
+        if budget is not None and len(recorder) > budget:
+            logger.warning('%s (%s) is over its budget of %d queries\n%s', request.path, url_name, budget,
+                           recorder.report())
+        elif recorder.repeated():
+            logger.warning('%s (%s) repeats queries\n%s', request.path, url_name, recorder.report())
+        return response
+
+
+@contextmanager
+def assert_query_budget(url_name=None, budget=None):
+    """
+    Test helper : fails if the block runs more queries than budget, or than the budget of url_name.
+
+        with assert_query_budget('principal_index'):
+            client.post(reverse('principal_index'), {'class': class_id})
+    """
+    if budget is None:
+        budget = get_budget(url_name)
+        if budget is None:
+            raise ValueError('No query budget for ' + str(url_name))
+    with QueryRecorder() as recorder:
+        yield recorder
+    if len(recorder) > budget:
+        raise AssertionError('{0} is over its budget of {1} queries : {2}'.format(
+            url_name or 'block', budget, recorder.report()))
@@ -0,0 +1,146 @@
+"""
+Cache of the computed reports, invalidated by a data version per class.
+
+Every report is cached under the current version of its class. Saving a Marks, Test, Subject, Attendance or
+Student of a class, or deleting a Test, Subject or Student, bumps the version of the class (once the transaction
+commits), so the next report is computed again and the old entries are left to expire. Bulk writes, which send
+no signals, call bump_versions themselves.
+
+Marks and Attendance have no delete receivers : they are only deleted with their test or student, whose
+receivers bump the class, and without receivers Django deletes them with one query instead of loading every row.
+
+The cache used is settings.REPORT_CACHE (a name of settings.CACHES, 'default' when not set).
+"""
+import logging
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from attendance import routers
+from attendance.models import Attendance, Marks, Student, Subject, Test
+
+logger = logging.getLogger('attendance.report_cache')
+
+CACHE_ALIAS = getattr(settings, 'REPORT_CACHE', 'default')
+TIMEOUT = getattr(settings, 'REPORT_CACHE_TIMEOUT', 24 * 60 * 60)
+
+VERSION_KEY = 'attendance:class_version:{0}'
+BUMPED_KEY = 'attendance:class_bumped:{0}'
+REPORT_KEY = 'attendance:report:{0}:{1}:{2}:{3}'
+STATS_KEY = 'attendance:report_cache:{0}'
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def _increment(key):
+    """
+    Adds one to a counter of the cache, starting it when it is missing
+    """
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def get_version(class_id):
+    """
+    returns the data version of the class
+    """
+    cache = get_cache()
+    version = cache.get(VERSION_KEY.format(class_id))
+    if version is None:
+        # a version starting from the clock is never one of an evicted counter, whose entries may still be there
+        cache.add(VERSION_KEY.format(class_id), int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY.format(class_id))
+    return version
+
+
+def _bump(class_ids):
+    cache = get_cache()
+    for class_id in class_ids:
+        try:
+            cache.incr(VERSION_KEY.format(class_id))
+        except ValueError:
+            get_version(class_id)
+        cache.set(BUMPED_KEY.format(class_id), time.time(), None)
+
+
+def bump_versions(class_ids):
+    """
+    Bumps the data version of every class in class_ids once the current transaction commits,
+    so a report computed from the uncommitted data is never cached under the new version
+    """
+    class_ids = set(class_id for class_id in class_ids if class_id is not None)
+    if class_ids:
+        transaction.on_commit(partial(_bump, class_ids))
+
+
+def cached_report(class_id, name, args, compute):
+    """
+    returns the report name of the class for args, a tuple of the values it depends on,
+    from the cache or else from compute() which is then cached
+    """
+    key = REPORT_KEY.format(class_id, get_version(class_id), name, ':'.join(str(arg) for arg in args))
+    cache = get_cache()
+    report = cache.get(key)
+    if report is not None:
+        _increment(STATS_KEY.format('hits'))
+        return report
+    _increment(STATS_KEY.format('misses'))
+    logger.debug('computing %s of class %s for %s', name, class_id, args)
+    report = compute()
+    timeout = TIMEOUT
+    lag = routers.get_replica_lag()
+    if routers.reading_replica() and time.time() - cache.get(BUMPED_KEY.format(class_id), 0) < lag:
+        # the replica may not have the writes of the last bump yet, the report is only kept until it does
+        timeout = lag
+    cache.set(key, report, timeout)
+    return report
+
+
+def get_stats():
+    """
+    returns a dictionary with the hits and misses of the report cache so far
+    """
+    counts = get_cache().get_many([STATS_KEY.format('hits'), STATS_KEY.format('misses')])
+    return {
+        'hits': counts.get(STATS_KEY.format('hits'), 0),
+        'misses': counts.get(STATS_KEY.format('misses'), 0),
+    }
+
+
+def reset_stats():
+    get_cache().delete_many([STATS_KEY.format('hits'), STATS_KEY.format('misses')])
+
+
+####################################################
+#           Invalidation                           #
+####################################################
+
+
+def _class_of_student(student_id):
+    return Student.objects.filter(id=student_id).values_list('which_class_id', flat=True)
+
+
+def _changed(sender, instance, **kwargs):
+    if sender is Subject or sender is Student:
+        class_ids = [instance.which_class_id]
+    elif sender is Test:
+        class_ids = Subject.objects.filter(id=instance.subject_id).values_list('which_class_id', flat=True)
+    else:
+        class_ids = _class_of_student(instance.student_id)
+    bump_versions(class_ids)
+
+
+for model in (Marks, Test, Subject, Attendance, Student):
+    post_save.connect(_changed, sender=model, dispatch_uid='report_cache_save_{0}'.format(model.__name__))
+for model in (Test, Subject, Student):
+    post_delete.connect(_changed, sender=model, dispatch_uid='report_cache_delete_{0}'.format(model.__name__))
@@ -0,0 +1,102 @@
+"""
+Report engine for the class and principal reports.
+
+All the marks of a class are fetched with one query and pivoted into a students x tests table,
+instead of getting every Marks object separately.
+"""
+from collections import OrderedDict
+from itertools import chain
+
+from attendance import archive
+from attendance.models import Marks, MarksArchive, Test
+
+
+class MarksMatrix(object):
+    """
+    Students x tests table of marks.
+
+    * mark_objects : one list per student of the Marks objects (None where missing), used by the templates
+    """
+
+    def __init__(self, student_list, test_list):
+        self.student_list = list(student_list)
+        self.test_list = list(test_list)
+        self.mark_objects = [[None] * len(self.test_list) for _ in self.student_list]
+
+    def fill(self, mark_list):
+        """
+        Places every Marks object of mark_list in its cell, marks of other students or tests are ignored
+        """
+        row_of = {student.id: row for row, student in enumerate(self.student_list)}
+        column_of = {test.id: column for column, test in enumerate(self.test_list)}
+        for mark in mark_list:
+            row = row_of.get(mark.student_id)
+            column = column_of.get(mark.test_id)
+            if row is None or column is None:
+                continue
+            # saves the lazy lookups from the templates
+            mark.student = self.student_list[row]
+            mark.test = self.test_list[column]
+            self.mark_objects[row][column] = mark
+        return self
+
+    def subject_columns(self, subject):
+        """
+        returns the column numbers of the tests of given subject, in the order of test_list
+        """
+        return [column for column, test in enumerate(self.test_list) if test.subject_id == subject.id]
+
+    def rows(self, columns=None):
+        """
+        returns a list (one per student) of lists of Marks objects, restricted to given columns if any
+        """
+        if columns is None:
+            return [list(row) for row in self.mark_objects]
+        return [[row[column] for column in columns] for row in self.mark_objects]
+
+
+def get_marks_matrix(student_list, test_list):
+    """
+    returns a MarksMatrix of the given students and tests, filled using a single query on Marks,
+    and one on MarksArchive when some of the tests are before the live year
+    """
+    matrix = MarksMatrix(student_list, test_list)
+    student_ids = [student.id for student in matrix.student_list]
+    test_ids = [test.id for test in matrix.test_list]
+    if student_ids and test_ids:
+        matrix.fill(Marks.objects.filter(student_id__in=student_ids, test_id__in=test_ids).iterator())
+        live_from = archive.live_from()
+        if any(test.date < live_from for test in matrix.test_list):
+            matrix.fill(MarksArchive.objects.filter(student_id__in=student_ids, test_id__in=test_ids).iterator())
+    return matrix
+
+
+def get_subject_report_list(student_list, subject_list, from_date=None):
+    """
+    returns a list of (subject, mark_list) for every subject in subject_list,
+    mark_list having one row of Marks per student and one column per test of the subject,
+    of the tests from archive.first_day(from_date) on.
+    Takes one query for the tests and one for the marks of all the subjects (two with the archive).
+    """
+    subject_list = list(subject_list)
+    test_list = Test.objects.filter(subject__in=[subject.id for subject in subject_list],
+                                    date__gte=archive.first_day(from_date)).order_by('id')
+    matrix = get_marks_matrix(student_list, test_list)
+    return [(subject, matrix.rows(matrix.subject_columns(subject))) for subject in subject_list]
+
+
+def get_report_card(student, from_date=None, to_date=None):
+    """
+    returns the marks of student as a list with one list of Marks per test name, ordered by subject name,
+    of the tests from archive.first_day(from_date) on, up to to_date when it is not None.
+    The test names are in the order of their first date, then of their name.
+    Takes a single query (two with the archive), the tests and subjects of the marks are fetched with them.
+    """
+    mark_list = sorted(chain.from_iterable(
+        marks.select_related('test__subject') for marks in archive.marks_lists(from_date, to_date, student=student)),
+        key=lambda mark: (mark.test.date, mark.test.name, mark.test.subject.name, mark.test_id))
+    report_card = OrderedDict()
+    for mark in mark_list:
+        report_card.setdefault(mark.test.name, []).append(mark)
+    return [sorted(marks, key=lambda mark: (mark.test.subject.name, mark.test.date, mark.test_id))
+            for marks in report_card.values()]
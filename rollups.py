@@ -0,0 +1,304 @@
+"""
+Incrementally maintained attendance counters.
+
+Every Attendance row is also counted in three AttendanceRollup buckets of its student : the day, the month
+and the term it falls in. Reports then add up a handful of buckets instead of scanning every attendance row.
+
+Every school day of a student also has an AttendancePrefix row holding the running totals up to that day,
+so the attendance between any two dates is the difference of two rows.
+"""
+import datetime
+import heapq
+import operator
+from collections import defaultdict
+from functools import reduce
+from itertools import chain
+
+from django.conf import settings
+from django.db.models import Case, F, IntegerField, Max, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.utils import timezone
+
+from attendance.models import AttendancePrefix, AttendanceRollup, Student
+
+# Months (1-12) in which a new term begins
+TERM_START_MONTHS = tuple(sorted(getattr(settings, 'ATTENDANCE_TERM_START_MONTHS', (6, 11))))
+
+PERIODS = (AttendanceRollup.DAY, AttendanceRollup.MONTH, AttendanceRollup.TERM)
+
+
+def as_day(value):
+    """
+    Attendance.date may come back as a datetime, reports are done on the local date
+    """
+    if isinstance(value, datetime.datetime):
+        if timezone.is_aware(value):
+            value = timezone.localtime(value)
+        return value.date()
+    return value
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def term_start(day):
+    started = [month for month in TERM_START_MONTHS if month <= day.month]
+    if started:
+        return datetime.date(day.year, started[-1], 1)
+    return datetime.date(day.year - 1, TERM_START_MONTHS[-1], 1)
+
+
+def bucket_start(period, day):
+    """
+    returns the first day of the bucket of given period that contains day
+    """
+    if period == AttendanceRollup.DAY:
+        return day
+    elif period == AttendanceRollup.MONTH:
+        return month_start(day)
+    return term_start(day)
+
+
+####################################################
+#           Writing                                #
+####################################################
+
+
+def apply_attendance_changes(changes):
+    """
+    Adds the changes to the rollups and the prefix rows of the students.
+    changes is an iterable of (student_id, day, present_change, total_change), for example
+    (id, day, 1, 1) for a new present row, (id, day, 0, 1) for a new absent row and
+    (id, day, -1, 0) when a row is changed from present to absent.
+
+    This has to be called in the same transaction that writes the Attendance rows.
+    The buckets of all the students are read, created and updated together, so a whole class takes a few queries.
+    """
+    # (present_change, total_change) -> (period, start) -> student ids
+    grouped = defaultdict(lambda: defaultdict(list))
+    buckets = defaultdict(set)
+    for student_id, day, present_change, total_change in changes:
+        if present_change == 0 and total_change == 0:
+            continue
+        day = as_day(day)
+        for period in PERIODS:
+            bucket = (period, bucket_start(period, day))
+            grouped[(present_change, total_change)][bucket].append(student_id)
+            buckets[bucket].add(student_id)
+
+    if buckets:
+        existing = set(AttendanceRollup.objects.filter(_in_buckets(buckets)).values_list(
+            'student_id', 'period', 'start'))
+        AttendanceRollup.objects.bulk_create([
+            AttendanceRollup(student_id=student_id, period=period, start=start)
+            for (period, start), student_ids in buckets.items() for student_id in student_ids
+            if (student_id, period, start) not in existing
+        ])
+        AttendanceRollup.objects.filter(_in_buckets(buckets)).update(
+            present=F('present') + _change_case(grouped, 0, _in_buckets),
+            total=F('total') + _change_case(grouped, 1, _in_buckets))
+
+    days = defaultdict(lambda: defaultdict(list))
+    for student_id, day, present_change, total_change in changes:
+        if present_change != 0 or total_change != 0:
+            days[as_day(day)][(present_change, total_change)].append(student_id)
+    for day, grouped in days.items():
+        _apply_prefix_changes(day, grouped)
+
+
+def _in_buckets(buckets):
+    """
+    returns the Q of the rollups of the students in given dictionary of (period, start) -> student ids
+    """
+    return reduce(operator.or_, [Q(period=period, start=start, student_id__in=student_ids)
+                                 for (period, start), student_ids in buckets.items()])
+
+
+def _change_case(grouped, position, condition):
+    """
+    returns the Case of the change at position (0 for present, 1 for total) of the rows matching condition(ids)
+    for the ids of each change of grouped, a dictionary of (present_change, total_change) -> ids
+    """
+    return Case(*[When(condition(ids), then=Value(change[position])) for change, ids in grouped.items()],
+                default=Value(0), output_field=IntegerField())
+
+
+def _of_students(student_ids):
+    return Q(student_id__in=student_ids)
+
+
+def _last_prefix(bound, day):
+    """
+    returns the subquery of the latest AttendancePrefix of the student of the outer query on or before day (bound
+    'lte') or strictly before day (bound 'lt')
+    """
+    return AttendancePrefix.objects.filter(**{'student': OuterRef('pk'), 'date__' + bound: day}).order_by('-date')
+
+
+def _prefix_bounds(student_ids, bounds):
+    """
+    returns a dictionary of student id -> tuple of (ordinal, present, total) of the latest prefix row of the student
+    before each of the (bound, day) in bounds, (0, 0, 0) when there is none. Takes a single query.
+    """
+    annotations = {}
+    for number, (bound, day) in enumerate(bounds):
+        for field in ('ordinal', 'present', 'total'):
+            annotations['{0}_{1}'.format(field, number)] = Subquery(_last_prefix(bound, day).values(field)[:1])
+    result = {}
+    for row in Student.objects.filter(id__in=student_ids).annotate(**annotations).values('id', *annotations):
+        result[row['id']] = tuple(
+            tuple(row['{0}_{1}'.format(field, number)] or 0 for field in ('ordinal', 'present', 'total'))
+            for number in range(len(bounds))
+        )
+    return result
+
+
+def _apply_prefix_changes(day, grouped):
+    """
+    Applies the changes of one day, grouped as (present_change, total_change) -> student ids, to the prefix rows
+    """
+    change_of = {}
+    for change, ids in grouped.items():
+        for student_id in ids:
+            change_of[student_id] = change
+    # the students with a row for the day, and those with rows after it (back dated attendance)
+    existing = set()
+    moved = set()
+    for row in AttendancePrefix.objects.filter(student_id__in=change_of, date__gte=day).values('student_id').annotate(
+            first=Min('date'), last=Max('date')):
+        if row['first'] == day:
+            existing.add(row['student_id'])
+        moved.add(row['student_id'])
+
+    # students whose first row for the day is being inserted, following the row before it
+    missing = set(change_of) - existing
+    if moved:
+        # every row from the day on, before the missing rows are inserted : the rows of a missing day also
+        # count one more school day
+        AttendancePrefix.objects.filter(student_id__in=moved, date__gte=day).update(
+            ordinal=F('ordinal') + Case(When(student_id__in=missing & moved, then=Value(1)), default=Value(0),
+                                        output_field=IntegerField()),
+            present=F('present') + _change_case(grouped, 0, _of_students),
+            total=F('total') + _change_case(grouped, 1, _of_students))
+    if missing:
+        previous = _prefix_bounds(missing, [('lt', day)])
+        AttendancePrefix.objects.bulk_create([
+            AttendancePrefix(student_id=student_id, date=day, ordinal=previous[student_id][0][0] + 1,
+                             present=previous[student_id][0][1] + change_of[student_id][0],
+                             total=previous[student_id][0][2] + change_of[student_id][1])
+            for student_id in missing
+        ])
+
+
+####################################################
+#           Reading                                #
+####################################################
+
+
+def _sum_rollups(rollup_list):
+    """
+    returns a dictionary of student id -> (present, total) of the given rollups
+    """
+    counts = rollup_list.order_by().values('student').annotate(present=Sum('present'), total=Sum('total'))
+    return {row['student']: (row['present'] or 0, row['total'] or 0) for row in counts}
+
+
+def count_complete(student_ids):
+    """
+    returns a dictionary of student id -> (present, total) over all the attendance taken so far
+    """
+    return _sum_rollups(AttendanceRollup.objects.filter(student_id__in=student_ids, period=AttendanceRollup.TERM))
+
+
+def count_from_to(student_ids, from_date, to_date):
+    """
+    returns a dictionary of student id -> (present, total) for the attendance between from_date and to_date, both
+    inclusive. Each student takes two lookups on the prefix rows, done for all the students in a single query.
+    """
+    bounds = _prefix_bounds(student_ids, [('lte', as_day(to_date)), ('lt', as_day(from_date))])
+    counts = {}
+    for student_id, ((_, end_present, end_total), (_, start_present, start_total)) in bounds.items():
+        counts[student_id] = (end_present - start_present, end_total - start_total)
+    return counts
+
+
+####################################################
+#           Rebuilding                             #
+####################################################
+
+
+def compute_rollups(*attendance_lists):
+    """
+    Counts the given Attendance (or AttendanceArchive) querysets into buckets,
+    returns a dictionary of (student_id, period, start) -> [present, total]
+    """
+    counts = defaultdict(lambda: [0, 0])
+    for student_id, date, is_present in chain.from_iterable(
+            attendance_list.values_list('student_id', 'date', 'is_present').iterator()
+            for attendance_list in attendance_lists):
+        day = as_day(date)
+        for period in PERIODS:
+            count = counts[(student_id, period, bucket_start(period, day))]
+            count[0] += int(is_present)
+            count[1] += 1
+    return counts
+
+
+def compute_prefixes(*attendance_lists):
+    """
+    Computes the prefix rows of the given Attendance (or AttendanceArchive) querysets taken together,
+    returns a dictionary of (student_id, date) -> [ordinal, present, total]
+    """
+    prefixes = {}
+    last_student_id = None
+    running = [0, 0, 0]
+    for student_id, date, is_present in heapq.merge(*[
+            attendance_list.order_by('student_id', 'date').values_list('student_id', 'date', 'is_present').iterator()
+            for attendance_list in attendance_lists]):
+        day = as_day(date)
+        if student_id != last_student_id:
+            last_student_id = student_id
+            running = [0, 0, 0]
+        if (student_id, day) not in prefixes:
+            running[0] += 1
+        running[1] += int(is_present)
+        running[2] += 1
+        prefixes[(student_id, day)] = list(running)
+    return prefixes
+
+
+def compare_prefixes(expected):
+    """
+    Compares the stored prefix rows with the expected ones from compute_prefixes.
+    returns a list of (student_id, date, stored, expected) for every row that differs,
+    stored and expected being (ordinal, present, total)
+    """
+    stored = {}
+    for student_id, date, ordinal, present, total in AttendancePrefix.objects.values_list(
+            'student_id', 'date', 'ordinal', 'present', 'total').iterator():
+        stored[(student_id, date)] = (ordinal, present, total)
+    mismatches = []
+    for key in set(stored) | set(expected):
+        stored_row = stored.get(key)
+        expected_row = tuple(expected[key]) if key in expected else None
+        if stored_row != expected_row:
+            mismatches.append(key + (stored_row, expected_row))
+    return sorted(mismatches, key=lambda mismatch: mismatch[:2])
+
+
+def compare_rollups(expected):
+    """
+    Compares the stored rollups with the expected counts from compute_rollups.
+    returns a list of (student_id, period, start, stored, expected) for every bucket that differs
+    """
+    stored = {}
+    for student_id, period, start, present, total in AttendanceRollup.objects.values_list(
+            'student_id', 'period', 'start', 'present', 'total').iterator():
+        stored[(student_id, period, start)] = (present, total)
+    mismatches = []
+    for key in set(stored) | set(expected):
+        stored_count = stored.get(key, (0, 0))
+        expected_count = tuple(expected.get(key, (0, 0)))
+        if stored_count != expected_count:
+            mismatches.append(key + (stored_count, expected_count))
+    return sorted(mismatches)
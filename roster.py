@@ -0,0 +1,144 @@
+"""
+Bulk import of the students of a class from a CSV roster.
+
+Every row is validated before anything is written, the passwords of the valid rows are hashed in a process
+pool and the users, students, group links and marks are then inserted in bulk, one transaction per batch.
+Rows with an error are reported with their line number and do not stop the others.
+"""
+import csv
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.db import IntegrityError, transaction
+
+from attendance.archive import live_from
+from attendance.models import Marks, Student, Test
+from attendance.report_cache import bump_versions
+
+ROSTER_COLUMNS = ('username', 'password', 'full_name', 'phone', 'roll')
+
+# same bounds as the teacher_add_student form
+PHONE_MIN = 999999999
+PHONE_MAX = 10000000000
+
+# rows saved per transaction
+BATCH_SIZE = 500
+
+# processes hashing the passwords, None for one per CPU
+HASH_WORKERS = getattr(settings, 'ROSTER_HASH_WORKERS', None)
+
+
+def read_roster(roster_file):
+    """
+    returns a list of (line number, row dictionary) of a CSV roster, given as an iterable of text lines.
+    The first line is the header and has to name all of ROSTER_COLUMNS
+    """
+    reader = csv.DictReader(roster_file)
+    missing = [column for column in ROSTER_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError('The roster has no {0} column'.format(', '.join(missing)))
+    return [(reader.line_num, row) for row in reader]
+
+
+def validate_roster(rows, class_id):
+    """
+    Checks every row of read_roster against the others and the database, in three queries.
+    returns (valid, errors), valid being a list of (line number, cleaned row dictionary)
+    and errors a list of (line number, message)
+    """
+    taken_rolls = set(Student.objects.filter(which_class_id=class_id).values_list('roll_no', flat=True))
+    usernames = [(row.get('username') or '').strip() for _, row in rows]
+    taken_usernames = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    max_length = User._meta.get_field('username').max_length
+
+    valid = []
+    errors = []
+    for line, row in rows:
+        username = (row.get('username') or '').strip()
+        full_name = (row.get('full_name') or '').strip()
+        password = row.get('password') or ''
+        try:
+            phone = int(row.get('phone') or '')
+            roll = int(row.get('roll') or '')
+        except ValueError:
+            errors.append((line, 'phone and roll have to be numbers'))
+            continue
+        if not username or not full_name or not password:
+            errors.append((line, 'username, password and full_name are required'))
+        elif len(username) > max_length:
+            errors.append((line, 'username {0} is longer than {1} characters'.format(username, max_length)))
+        elif username in taken_usernames:
+            errors.append((line, 'username {0} already exists'.format(username)))
+        elif phone < PHONE_MIN or phone > PHONE_MAX:
+            errors.append((line, 'phone {0} is not a valid phone number'.format(phone)))
+        elif roll in taken_rolls:
+            errors.append((line, 'roll no {0} already exists in the class'.format(roll)))
+        else:
+            taken_usernames.add(username)
+            taken_rolls.add(roll)
+            valid.append((line, {'username': username, 'password': password, 'full_name': full_name,
+                                 'phone': phone, 'roll': roll}))
+    return valid, errors
+
+
+def hash_passwords(passwords, workers=HASH_WORKERS):
+    """
+    returns the list of make_password of every password, hashed in a pool of worker processes
+    """
+    passwords = list(passwords)
+    if workers == 1 or len(passwords) < 2:
+        return [make_password(password) for password in passwords]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(make_password, passwords, chunksize=16))
+
+
+def _save_batch(batch, which_class, group, test_ids):
+    with transaction.atomic():
+        User.objects.bulk_create([User(username=row['username'], password=row['password']) for row in batch])
+        user_ids = dict(User.objects.filter(username__in=[row['username'] for row in batch])
+                        .values_list('username', 'id'))
+        User.groups.through.objects.bulk_create([
+            User.groups.through(user_id=user_ids[row['username']], group_id=group.id) for row in batch
+        ])
+        Student.objects.bulk_create([
+            Student(user_id=user_ids[row['username']], which_class=which_class, name=row['full_name'],
+                    phone=row['phone'], roll_no=row['roll'])
+            for row in batch
+        ])
+        student_ids = Student.objects.filter(user_id__in=user_ids.values()).values_list('id', flat=True)
+        Marks.objects.bulk_create([
+            Marks(test_id=test_id, student_id=student_id, marks=0) for student_id in student_ids for test_id in test_ids
+        ])
+
+
+def import_roster(roster_file, which_class):
+    """
+    Adds the students of a CSV roster to which_class, with a 0 mark for every existing test of the class
+    like teacher_add_student.
+    returns (number of students added, errors), errors being a sorted list of (line number, message)
+    """
+    rows = read_roster(roster_file)
+    valid, errors = validate_roster(rows, which_class.id)
+    hashed = hash_passwords([row['password'] for _, row in valid])
+    for (_, row), password in zip(valid, hashed):
+        row['password'] = password
+
+    group = Group.objects.get(name='Student')
+    # the tests of past years are archived, their marks too
+    test_ids = list(Test.objects.filter(subject__which_class=which_class, date__gte=live_from()).values_list(
+        'id', flat=True))
+    added = 0
+    for start in range(0, len(valid), BATCH_SIZE):
+        batch = valid[start:start + BATCH_SIZE]
+        try:
+            _save_batch([row for _, row in batch], which_class, group, test_ids)
+        except IntegrityError:
+            # a username was taken after the validation, the batch is rolled back as a whole
+            errors.extend((line, 'not saved, a username of the batch was taken meanwhile') for line, _ in batch)
+        else:
+            added += len(batch)
+    if added:
+        bump_versions([which_class.id])
+    return added, sorted(errors)
@@ -0,0 +1,147 @@
+"""
+Read replica routing of the report views.
+
+* ReplicaRouter sends the reads of a request to the replica while the request is marked as a report request,
+  and every write to the primary (default) database
+* ReplicaMiddleware marks the requests of REPLICA_VIEWS as report requests, unless the client wrote less than
+  REPLICA_LAG seconds ago : then the replica may not have its writes yet and the primary is read instead.
+  A request that writes is pinned to the primary for the rest of the request, and a cookie holding the time
+  of the write pins the next requests of the client for REPLICA_LAG seconds.
+
+Settings :
+* DATABASE_ROUTERS = ['attendance.routers.ReplicaRouter']
+* MIDDLEWARE : 'attendance.routers.ReplicaMiddleware', after the authentication middleware
+* REPLICA_DATABASE : the alias of the replica in DATABASES, 'replica' by default. Without it nothing is routed.
+* REPLICA_VIEWS : url names of the views whose reads go to the replica, DEFAULT_REPLICA_VIEWS by default
+* REPLICA_LAG : seconds a client is kept on the primary after a write, 5 by default
+
+The rows of a streaming response are read after the middleware is done with the request, from the primary.
+
+For local testing two SQLite files will do, the replica being a copy of the primary's file.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS
+
+DEFAULT_REPLICA_VIEWS = (
+    'principal_index',
+    'principal_statistics',
+    'teacher_report_class',
+    'teacher_report_view_single',
+    'student_index',
+)
+
+# apps read from the primary in any case, a session or a login read from a lagging replica would log the user out
+PRIMARY_APPS = ('auth', 'sessions', 'contenttypes', 'admin')
+
+# cookie holding the time of the last write of the client
+LAST_WRITE_COOKIE = 'last_write'
+
+
+def get_replica_alias():
+    """
+    returns the alias of the replica, None if there is none in DATABASES
+    """
+    alias = getattr(settings, 'REPLICA_DATABASE', 'replica')
+    if alias in settings.DATABASES:
+        return alias
+    return None
+
+
+def get_replica_views():
+    return frozenset(getattr(settings, 'REPLICA_VIEWS', DEFAULT_REPLICA_VIEWS))
+
+
+def get_replica_lag():
+    return getattr(settings, 'REPLICA_LAG', 5)
+
+
+class _RequestState(threading.local):
+    """
+    Routing state of the request being served by the current thread
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.use_replica = False
+        self.wrote = False
+
+
+state = _RequestState()
+
+
+def reading_replica():
+    """
+    returns True when the reads of the current request go to the replica
+    """
+    return state.use_replica and not state.wrote and get_replica_alias() is not None
+
+
+class ReplicaRouter(object):
+    """
+    Database router sending the reads of report requests to the replica and all the writes to the primary
+    """
+
+    def db_for_read(self, model, **hints):
+        if reading_replica() and model._meta.app_label not in PRIMARY_APPS:
+            return get_replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        # the reads after a write, in the same request, have to see it
+        state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        databases = (DEFAULT_DB_ALIAS, get_replica_alias())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+class ReplicaMiddleware(object):
+    """
+    Marks the requests of REPLICA_VIEWS as report requests, see the module documentation
+    """
+
+    def __init__(self, get_response):
+        if get_replica_alias() is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.replica_views = get_replica_views()
+
+    def __call__(self, request):
+        state.reset()
+        try:
+            response = self.get_response(request)
+            if state.wrote:
+                response.set_cookie(LAST_WRITE_COOKIE, repr(time.time()), max_age=int(get_replica_lag()) + 1,
+                                    httponly=True)
+            return response
+        finally:
+            state.reset()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        if url_name in self.replica_views and not self.recently_wrote(request):
+            state.use_replica = True
+        return None
+
+    def recently_wrote(self, request):
+        """
+        returns True when the client wrote less than REPLICA_LAG seconds ago
+        """
+        try:
+            last_write = float(request.COOKIES.get(LAST_WRITE_COOKIE, 0))
+        except ValueError:
+            return False
+        return time.time() - last_write < get_replica_lag()
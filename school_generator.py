@@ -0,0 +1,162 @@
+"""
+Synthetic school generator, to measure the views at real scale.
+
+Everything is created with bulk inserts, and the same seed always gives the same school.
+The attendance is written both as Attendance rows (with their rollups and prefix rows) and as packed bitsets,
+so the views can be measured with either ATTENDANCE_STORE.
+"""
+import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.utils import timezone
+
+from attendance import absence, archive, attendance_store, rollups
+from attendance.models import AbsenceTracker, Attendance, AttendancePrefix, AttendanceRollup, Class, Marks, \
+    PackedAttendance, Principal, Student, Subject, Teacher, Test
+
+# every generated user has this password
+PASSWORD = 'password'
+
+BATCH_SIZE = 2000
+
+
+def _bulk_create(model, objects):
+    """
+    Inserts the objects of an iterable in batches, without holding all of them in memory
+    """
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+
+
+def school_days(start, count):
+    """
+    returns a list of the first count week days from start
+    """
+    days = []
+    day = start
+    while len(days) < count:
+        if day.weekday() < 5:
+            days.append(day)
+        day += datetime.timedelta(days=1)
+    return days
+
+
+def generate_school(seed=0, classes=2, students=30, subjects=5, tests=4, days=60, start=None):
+    """
+    Creates classes with a teacher, students, subjects, tests with the marks of every student
+    and days of attendance, plus a principal. Usernames start with 'gen<seed>_'.
+    Nothing is dated after today : the attendance stops at today and the later tests are moved to today.
+    returns a dictionary with the usernames to log in with and some ids for the report forms :
+    principal, teachers, students (usernames), class_ids, subject_ids, student_ids (per class)
+    """
+    rng = random.Random(seed)
+    if start is None:
+        # the live views only show the current academic year
+        start = archive.live_from()
+    today = timezone.now().date()
+    prefix = 'gen{0}_'.format(seed)
+    password = make_password(PASSWORD)
+    groups = {}
+    for name in ('Teacher', 'Student', 'Admin', 'Principal'):
+        groups[name], _ = Group.objects.get_or_create(name=name)
+
+    with transaction.atomic():
+        class_list = [Class.objects.create(grade=1 + number // 4, division='ABCD'[number % 4])
+                      for number in range(classes)]
+
+        usernames = {prefix + 'principal': 'Principal'}
+        for class_number in range(classes):
+            usernames['{0}teacher{1}'.format(prefix, class_number)] = 'Teacher'
+            for roll_no in range(1, students + 1):
+                usernames['{0}student{1}_{2}'.format(prefix, class_number, roll_no)] = 'Student'
+        User.objects.bulk_create([User(username=username, password=password) for username in sorted(usernames)])
+        user_ids = dict(User.objects.filter(username__startswith=prefix).values_list('username', 'id'))
+        User.groups.through.objects.bulk_create([
+            User.groups.through(user_id=user_ids[username], group_id=groups[group].id)
+            for username, group in usernames.items()
+        ])
+
+        Principal.objects.create(user_id=user_ids[prefix + 'principal'])
+        Teacher.objects.bulk_create([
+            Teacher(user_id=user_ids['{0}teacher{1}'.format(prefix, class_number)], which_class=which_class,
+                    name='Teacher {0}'.format(which_class))
+            for class_number, which_class in enumerate(class_list)
+        ])
+        Student.objects.bulk_create([
+            Student(user_id=user_ids['{0}student{1}_{2}'.format(prefix, class_number, roll_no)],
+                    which_class=which_class, phone=rng.randint(7000000000, 9999999999), roll_no=roll_no,
+                    name='Student {0} {1}'.format(which_class, roll_no))
+            for class_number, which_class in enumerate(class_list)
+            for roll_no in range(1, students + 1)
+        ])
+        student_list = list(Student.objects.filter(which_class__in=class_list).order_by('which_class', 'roll_no'))
+
+        Subject.objects.bulk_create([
+            Subject(name='Subject {0}'.format(number + 1), which_class=which_class)
+            for which_class in class_list
+            for number in range(subjects)
+        ])
+        subject_list = list(Subject.objects.filter(which_class__in=class_list).order_by('id'))
+
+        test_days = sorted(rng.sample(range(max(days, tests)), tests))
+        Test.objects.bulk_create([
+            Test(subject=subject, total_marks=100, name='Test {0}'.format(number + 1),
+                 date=min(start + datetime.timedelta(days=test_day), today))
+            for subject in subject_list
+            for number, test_day in enumerate(test_days)
+        ])
+        test_list = list(Test.objects.filter(subject__in=subject_list).select_related('subject'))
+
+        students_of = {}
+        for student in student_list:
+            students_of.setdefault(student.which_class_id, []).append(student)
+        _bulk_create(Marks, (
+            Marks(test=test, student=student, marks=rng.randint(0, test.total_marks))
+            for test in test_list
+            for student in students_of[test.subject.which_class_id]
+        ))
+
+        _bulk_create(Attendance, (
+            Attendance(student=student, date=day, is_present=rng.random() < 0.9)
+            for day in school_days(start, days) if day <= today
+            for student in student_list
+        ))
+        attendance_list = Attendance.objects.filter(student__in=student_list)
+        counts = rollups.compute_rollups(attendance_list)
+        _bulk_create(AttendanceRollup, (
+            AttendanceRollup(student_id=student_id, period=period, start=bucket, present=present, total=total)
+            for (student_id, period, bucket), (present, total) in counts.items()
+        ))
+        prefixes = rollups.compute_prefixes(attendance_list)
+        _bulk_create(AttendancePrefix, (
+            AttendancePrefix(student_id=student_id, date=date, ordinal=ordinal, present=present, total=total)
+            for (student_id, date), (ordinal, present, total) in prefixes.items()
+        ))
+        _bulk_create(PackedAttendance, (
+            PackedAttendance(student_id=student_id, term_start=term_start, taken=attendance_store.to_bytes(taken),
+                             present=attendance_store.to_bytes(present))
+            for (student_id, term_start), (taken, present) in attendance_store.pack_rows(attendance_list).items()
+        ))
+        # counted from the rows just created, whichever store the settings select
+        _bulk_create(AbsenceTracker, absence.build_trackers(
+            [student.id for student in student_list], attendance_store.RowStore()))
+
+    return {
+        'principal': prefix + 'principal',
+        'teachers': ['{0}teacher{1}'.format(prefix, class_number) for class_number in range(classes)],
+        'students': [['{0}student{1}_{2}'.format(prefix, class_number, roll_no)
+                      for roll_no in range(1, students + 1)] for class_number in range(classes)],
+        'class_ids': [which_class.id for which_class in class_list],
+        'subject_ids': [[subject.id for subject in subject_list if subject.which_class_id == which_class.id]
+                        for which_class in class_list],
+        'student_ids': [[student.id for student in students_of[which_class.id]] for which_class in class_list],
+    }
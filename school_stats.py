@@ -0,0 +1,163 @@
+"""
+School wide statistics of the marks and the attendance, for the principal.
+
+All the marks of the current academic year are loaded as flat arrays by a single query and turned into percentages
+of the total marks of their test, and the statistics of every subject, test and class are grouped reductions over
+those arrays. The marks of past years are left out, whether close_academic_year archived them yet or not.
+"""
+import numpy
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+
+from attendance import archive
+from attendance.attendance_store import get_store
+from attendance.models import Class, Student, Subject, Test
+
+# percentage of the total marks needed to pass a test
+PASS_PERCENTAGE = getattr(settings, 'PASS_PERCENTAGE', 35)
+
+PERCENTILES = (10, 25, 75, 90)
+
+# bins of the attendance distribution, in percent present
+ATTENDANCE_BINS = numpy.arange(0, 101, 10)
+
+
+def _fetch_rows(queryset):
+    """
+    returns the rows of a values_list queryset, fetched straight from the cursor as the ORM would take
+    several times longer to build them one by one
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def load_marks():
+    """
+    returns a dictionary of flat arrays with one item per mark of the current academic year : percentage (of the
+    total marks of the test), test, subject and class (ids). Tests of 0 total marks are left out.
+    Takes one query for the marks and one for the tests.
+    """
+    tests = numpy.array(Test.objects.filter(date__gte=archive.live_from()).order_by('id').values_list(
+        'id', 'total_marks', 'subject_id', 'subject__which_class_id'), dtype=numpy.int64).reshape(-1, 4)
+    rows = []
+    for mark_list in archive.marks_lists():
+        # the SQL has the fields before the annotations, whatever the order of values_list
+        rows.extend(_fetch_rows(mark_list.annotate(value=Cast('marks', FloatField())).values_list('test_id', 'value')))
+    marks = numpy.array(rows, dtype=float).reshape(-1, 2)
+    # row of the test of every mark in tests
+    test_rows = numpy.searchsorted(tests[:, 0], marks[:, 0].astype(numpy.int64))
+    total_marks = tests[test_rows, 1]
+    counted = total_marks > 0
+    test_rows = test_rows[counted]
+    return {
+        'percentage': marks[counted, 1] * 100 / total_marks[counted],
+        'test': tests[test_rows, 0],
+        'subject': tests[test_rows, 2],
+        'class': tests[test_rows, 3],
+    }
+
+
+def grouped_statistics(keys, values, pass_mark=None):
+    """
+    returns a dictionary of key -> statistics of the values having that key, keys and values being arrays
+    of the same length. The statistics are a dictionary with count, mean, median, std, the PERCENTILES
+    (as p10, p25 ...) and pass_rate, the percentage of values of at least pass_mark, when pass_mark is given.
+    """
+    if len(values) == 0:
+        return {}
+    # sorted by key, then value, so every group is a sorted slice
+    order = numpy.lexsort((values, keys))
+    keys = keys[order]
+    values = values[order]
+    group_keys, starts, counts = numpy.unique(keys, return_index=True, return_counts=True)
+
+    sums = numpy.add.reduceat(values, starts)
+    means = sums / counts
+    deviations = values - numpy.repeat(means, counts)
+    stds = numpy.sqrt(numpy.add.reduceat(deviations * deviations, starts) / counts)
+
+    def percentile(q):
+        # linear interpolation between the two closest values of each group, like numpy.percentile
+        position = starts + (counts - 1) * (q / 100.0)
+        below = numpy.floor(position).astype(numpy.int64)
+        above = numpy.ceil(position).astype(numpy.int64)
+        return values[below] + (values[above] - values[below]) * (position - below)
+
+    columns = {'count': counts, 'mean': means, 'median': percentile(50), 'std': stds}
+    for q in PERCENTILES:
+        columns['p{0}'.format(q)] = percentile(q)
+    if pass_mark is not None:
+        columns['pass_rate'] = numpy.add.reduceat((values >= pass_mark).astype(float), starts) / counts * 100
+
+    statistics = {}
+    for number, key in enumerate(group_keys.tolist()):
+        statistics[key] = {name: column[number].item() for name, column in columns.items()}
+    return statistics
+
+
+def _named(statistics, names):
+    """
+    returns a list of (name, statistics) sorted by name, of the groups in statistics that are in names
+    """
+    return sorted(((names[key], row) for key, row in statistics.items() if key in names), key=lambda item: item[0])
+
+
+def attendance_statistics(classes=None):
+    """
+    returns the attendance percentage of every student of the school, summarised :
+    * classes : list of (class, statistics) of the percentage present of the students of the class
+    * school : statistics of the whole school
+    * distribution : list of (from, to, number of students) over ATTENDANCE_BINS
+    classes is a dictionary of class id -> name, loaded when not given
+    """
+    if classes is None:
+        classes = {which_class.id: str(which_class) for which_class in Class.objects.all()}
+    student_ids, class_ids = [], []
+    for student_id, class_id in Student.objects.values_list('id', 'which_class_id').iterator():
+        student_ids.append(student_id)
+        class_ids.append(class_id)
+    counts = get_store().count_complete(student_ids)
+    counted = [(class_id, counts[student_id]) for student_id, class_id in zip(student_ids, class_ids)
+               if counts.get(student_id, (0, 0))[1] > 0]
+    class_ids = numpy.array([class_id for class_id, _ in counted], dtype=numpy.int64)
+    present = numpy.array([count[0] for _, count in counted], dtype=float)
+    total = numpy.array([count[1] for _, count in counted], dtype=float)
+    percentage = present * 100 / total if len(total) else numpy.zeros(0)
+
+    histogram, edges = numpy.histogram(percentage, bins=ATTENDANCE_BINS)
+    return {
+        'classes': _named(grouped_statistics(class_ids, percentage), classes),
+        'school': grouped_statistics(numpy.zeros(len(percentage), dtype=numpy.int64), percentage).get(0),
+        'distribution': [(int(edges[number]), int(edges[number + 1]), int(count))
+                         for number, count in enumerate(histogram)],
+    }
+
+
+def school_statistics():
+    """
+    returns the statistics of the marks of the school, in percent of the total marks of each test :
+    * subjects, tests, classes : lists of (name, statistics) per subject, test and class, see grouped_statistics
+    * school : statistics of all the marks
+    * attendance : see attendance_statistics
+    """
+    marks = load_marks()
+    percentage = marks['percentage']
+    classes = {which_class.id: str(which_class) for which_class in Class.objects.all()}
+    subjects = {subject.id: '{0} {1}'.format(classes.get(subject.which_class_id, ''), subject.name)
+                for subject in Subject.objects.all()}
+    tests = {test_id: '{0} {1} ({2})'.format(subjects.get(subject_id, ''), name, date)
+             for test_id, subject_id, name, date in Test.objects.filter(date__gte=archive.live_from()).values_list(
+                 'id', 'subject_id', 'name', 'date')}
+    return {
+        'subjects': _named(grouped_statistics(marks['subject'], percentage, PASS_PERCENTAGE), subjects),
+        'tests': _named(grouped_statistics(marks['test'], percentage, PASS_PERCENTAGE), tests),
+        'classes': _named(grouped_statistics(marks['class'], percentage, PASS_PERCENTAGE), classes),
+        'school': grouped_statistics(numpy.zeros(len(percentage), dtype=numpy.int64), percentage,
+                                     PASS_PERCENTAGE).get(0),
+        'attendance': attendance_statistics(classes),
+    }
@@ -1,7 +1,17 @@
+import datetime
+import smtplib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import IntegrityError, transaction
 from django.utils import timezone
 
-from attendance.models import Attendance
+from attendance.attendance_store import get_store
+from attendance.models import OutboxMessage, Student
 
 data = {
     'uname': 'rubais',
@@ -14,14 +24,247 @@ data = {
 
 BASE_URL = "http://sms.lyvee.com/sendsms"
 
-today_date = timezone.now()
+# Number of messages sent at the same time, and seconds to wait for the gateway on each of them
+CONCURRENCY = 10
+TIMEOUT = 10
+
+# Outbox worker : messages claimed per batch, tries before giving up, seconds before the first retry
+# (doubled on every further try) and seconds an in flight message stays claimed by a worker
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60
+CLAIM_TIMEOUT = 300
+
+# how parents hear of the absences of their children, 'sms' or 'email'. Children without a parent, or parents
+# without an email address, get an SMS in any case
+NOTIFICATION_CHANNEL = getattr(settings, 'ABSENCE_NOTIFICATION_CHANNEL', OutboxMessage.SMS)
+
+
+class DispatchReport(object):
+    """
+    Result of a dispatch : sent is a list of message keys, failed a list of (key, error)
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.failed = []
+
+    def __str__(self):
+        return '{0} sent, {1} failed'.format(len(self.sent), len(self.failed))
+
+
+def get_absent_digests(date=None, channel=NOTIFICATION_CHANNEL):
+    """
+    returns a list of (channel, recipient, children) for every contact of the students absent on date (today by
+    default) : their parents, by channel, or the student's own phone when the student has no parent.
+    children is an ordered dictionary of student id -> name.
+    The absences come from the attendance store, the students and parents are read with them in a single query
+    (with one more for the packed store).
+    """
+    if date is None:
+        date = timezone.now().date()
+    children = OrderedDict()
+    for student_id, name, student_phone, parent_phone, parent_email in Student.objects.filter(
+            id__in=get_store().absent_ids(date)).order_by('name', 'id').values_list(
+            'id', 'name', 'phone', 'user__parent__phone', 'user__parent__email'):
+        if parent_phone is None:
+            contact = (OutboxMessage.SMS, str(student_phone))
+        elif channel == OutboxMessage.EMAIL and parent_email:
+            contact = (OutboxMessage.EMAIL, parent_email)
+        else:
+            contact = (OutboxMessage.SMS, str(parent_phone))
+        # a parent listed twice for the same child hears of it once
+        children.setdefault(contact, OrderedDict())[student_id] = name
+    return [(contact[0], contact[1], names) for contact, names in children.items()]
+
+
+def digest_message(names, date):
+    """
+    returns the message telling a parent that the children in names were absent on date
+    """
+    if len(names) == 1:
+        return 'Your ward {0} was absent on {1}'.format(names[0], date)
+    return 'Your wards {0} and {1} were absent on {2}'.format(', '.join(names[:-1]), names[-1], date)
+
+
+def get_session(concurrency=CONCURRENCY):
+    """
+    returns a requests Session keeping up to concurrency connections to the gateway alive
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _send(session, base_url, key, to, msg, timeout):
+    params = dict(data, to=to, msg=msg)
+    try:
+        r = session.get(base_url, params=params, timeout=timeout)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        return key, e
+    return key, None
+
+
+def dispatch(messages, base_url=BASE_URL, concurrency=CONCURRENCY, timeout=TIMEOUT):
+    """
+    Sends the (key, phone number, message) triples through the gateway at base_url,
+    at most concurrency at a time over pooled keep-alive connections.
+    returns a DispatchReport
+    """
+    report = DispatchReport()
+    session = get_session(concurrency)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(_send, session, base_url, key, to, msg, timeout)
+                       for key, to, msg in messages]
+            for future in futures:
+                key, error = future.result()
+                if error is None:
+                    report.sent.append(key)
+                else:
+                    report.failed.append((key, error))
+    finally:
+        session.close()
+    return report
+
+
+def send_emails(messages):
+    """
+    Sends the (key, address, subject, message) emails through Django's email backend, over a single connection.
+    returns a DispatchReport
+    """
+    report = DispatchReport()
+    if not messages:
+        return report
+    connection = get_connection()
+    try:
+        connection.open()
+    except (smtplib.SMTPException, OSError) as e:
+        report.failed.extend((key, e) for key, _, _, _ in messages)
+        return report
+    try:
+        for key, address, subject, message in messages:
+            try:
+                EmailMessage(subject, message, to=[address], connection=connection).send()
+            except (smtplib.SMTPException, OSError) as e:
+                report.failed.append((key, e))
+            else:
+                report.sent.append(key)
+    finally:
+        connection.close()
+    return report
+
+
+####################################################
+#           Outbox                                 #
+####################################################
+
+
+def queue_absent_messages(date=None, channel=NOTIFICATION_CHANNEL):
+    """
+    Puts one message per contact of the students absent on date (today by default) in the outbox,
+    covering all the absent children of the contact, see get_absent_digests.
+    A contact already having messages for that date only gets a follow up for the children they did not tell of.
+    Messages queued meanwhile by another run are skipped.
+    returns the number of messages queued
+    """
+    if date is None:
+        date = timezone.now().date()
+    digests = get_absent_digests(date, channel)
+    told = defaultdict(set)
+    next_sequence = defaultdict(int)
+    for by, recipient, sequence, student_ids in OutboxMessage.objects.filter(
+            date=date, recipient__in=[recipient for _, recipient, _ in digests]).values_list(
+            'channel', 'recipient', 'sequence', 'student_ids'):
+        told[(by, recipient)].update(int(student_id) for student_id in student_ids.split(',') if student_id)
+        next_sequence[(by, recipient)] = max(next_sequence[(by, recipient)], sequence + 1)
+    new_messages = []
+    for by, recipient, children in digests:
+        untold = [(student_id, name) for student_id, name in children.items()
+                  if student_id not in told[(by, recipient)]]
+        if untold:
+            new_messages.append(OutboxMessage(
+                channel=by, recipient=recipient, date=date, sequence=next_sequence[(by, recipient)],
+                student_ids=','.join(str(student_id) for student_id, _ in untold),
+                subject='Absence on {0}'.format(date) if by == OutboxMessage.EMAIL else '',
+                message=digest_message([name for _, name in untold], date)))
+    try:
+        with transaction.atomic():
+            OutboxMessage.objects.bulk_create(new_messages)
+        return len(new_messages)
+    except IntegrityError:
+        pass
+    # another run queued some of them at the same time, the others are inserted one by one
+    queued = 0
+    for message in new_messages:
+        try:
+            with transaction.atomic():
+                message.save()
+        except IntegrityError:
+            continue
+        queued += 1
+    return queued
+
+
+def claim_messages(batch_size=BATCH_SIZE):
+    """
+    Marks up to batch_size due messages as in flight and returns them.
+    In flight messages whose claim ran out (the worker died) are claimed again.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        message_list = list(OutboxMessage.objects.select_for_update().filter(
+            status__in=[OutboxMessage.QUEUED, OutboxMessage.SENDING], next_attempt__lte=now
+        ).order_by('next_attempt')[:batch_size])
+        OutboxMessage.objects.filter(id__in=[message.id for message in message_list]).update(
+            status=OutboxMessage.SENDING, next_attempt=now + datetime.timedelta(seconds=CLAIM_TIMEOUT))
+    return message_list
+
+
+def retry_delay(attempts):
+    """
+    returns the time to wait before trying a message again after given number of failed attempts
+    """
+    return datetime.timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def process_outbox(batch_size=BATCH_SIZE, base_url=BASE_URL, concurrency=CONCURRENCY, timeout=TIMEOUT):
+    """
+    Sends one batch of the outbox and records the outcome of every message.
+    Failed messages are queued again with exponential backoff, up to MAX_ATTEMPTS tries.
+    returns the DispatchReport of the batch
+    """
+    message_list = claim_messages(batch_size)
+    if not message_list:
+        return DispatchReport()
+    report = dispatch([(message.id, message.recipient, message.message) for message in message_list
+                       if message.channel == OutboxMessage.SMS],
+                      base_url=base_url, concurrency=concurrency, timeout=timeout)
+    email_report = send_emails([(message.id, message.recipient, message.subject, message.message)
+                                for message in message_list if message.channel == OutboxMessage.EMAIL])
+    report.sent.extend(email_report.sent)
+    report.failed.extend(email_report.failed)
+    now = timezone.now()
+    OutboxMessage.objects.filter(id__in=report.sent).update(
+        status=OutboxMessage.SENT, sent_at=now, last_error='')
+    message_dict = {message.id: message for message in message_list}
+    for key, error in report.failed:
+        message = message_dict[key]
+        attempts = message.attempts + 1
+        if attempts >= MAX_ATTEMPTS:
+            status = OutboxMessage.FAILED
+        else:
+            status = OutboxMessage.QUEUED
+        OutboxMessage.objects.filter(id=key).update(status=status, attempts=attempts, last_error=str(error),
+                                                    next_attempt=now + retry_delay(attempts))
+    return report
 
 
 def send_sms():
-    for attendance in Attendance.objects.filter(date=today_date.date()):
-        if not attendance.is_present:
-            data['to'] = str(attendance.student.phone)
-            data['msg'] = 'Your ward ' + attendance.student.user.username + ' Was absent on ' + str(
-                timezone.now().date())
-            r = requests.get(BASE_URL, data)
-            print(r.url)
+    """
+    Queues today's absence messages, one per parent, the sms worker sends them
+    """
+    return queue_absent_messages()
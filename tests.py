@@ -0,0 +1,789 @@
+"""
+Tests of the app.
+
+The tests of the read replica routing need a second database in the test settings, e.g.
+DATABASES['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'replica.sqlite3'},
+they are skipped without it.
+"""
+import datetime
+import inspect
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from socketserver import ThreadingMixIn
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlparse
+
+from django.conf.urls import url
+from django.contrib.auth.models import Group, User
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from attendance import absence, report_cache, rollups, roster, routers, sms_sender, views
+from attendance.archive import live_from
+from attendance.attendance_store import PackedStore, RowStore
+from attendance.helper import save_attendance
+from attendance.models import AbsenceTracker, Attendance, AttendancePrefix, AttendanceRollup, Class, Marks, \
+    OutboxMessage, PackedAttendance, Parent, Student, Subject, Test
+from attendance.query_budget import QueryRecorder, assert_query_budget
+from attendance.school_generator import generate_school
+
+
+####################################################
+#           Views and templates of the tests       #
+####################################################
+
+
+def read_view(request):
+    # reads the session and the user, like the views checking the group of the user
+    return HttpResponse('{0} {1}'.format(request.user.username, Student.objects.count()))
+
+
+def write_view(request):
+    Class.objects.create(grade=1, division='A')
+    # read after the write, it has to see it
+    return HttpResponse(str(Class.objects.count()))
+
+
+BUDGETED_VIEWS = ('principal_index', 'student_index', 'teacher_report_view_single', 'teacher_report_class',
+                  'teacher_attendance_today')
+
+# the other views whose query plans are checked
+PLANNED_VIEWS = BUDGETED_VIEWS + ('teacher_test_edit', 'teacher_attendance_edit', 'teacher_student_edit',
+                                  'teacher_report_class_export')
+
+urlpatterns = [url(r'^{0}/$'.format(name), getattr(views, name), name=name) for name in PLANNED_VIEWS] + [
+    url(r'^teacher_test_select/$', views.teacher_test_edit, name='teacher_test_select'),
+    url(r'^replica/read/$', read_view, name='replica_read'),
+    url(r'^replica/write/$', write_view, name='replica_write'),
+    url(r'^primary/read/$', read_view, name='primary_read'),
+]
+
+# every template of the views iterates the lists of its context, so their queries are run
+TEMPLATE_BODY = ''.join('{{% for row in {0} %}}{{{{ row }}}}{{% endfor %}}'.format(name) for name in (
+    'student_list', 'class_list', 'subject_list', 'at_risk_list', 'mark_list', 'attendance_list',
+    'subject_report_list'))
+
+TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', {
+        name: TEMPLATE_BODY for name in re.findall(r"'(attendance/[\w.]+\.html)'", inspect.getsource(views))})]},
+}]
+
+
+####################################################
+#           Query budgets                          #
+####################################################
+
+
+@override_settings(ROOT_URLCONF='attendance.tests', TEMPLATES=TEMPLATES, MIDDLEWARE=[
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+], DATABASE_ROUTERS=[])
+class SchoolTestCase(TestCase):
+    """
+    The views of a generated school, with the report cache empty
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.school = generate_school(students=10, subjects=2, tests=2, days=10)
+
+    def setUp(self):
+        report_cache.get_cache().clear()
+
+    def login(self, username):
+        self.client.force_login(User.objects.get(username=username))
+
+
+class QueryBudgetTests(SchoolTestCase):
+    """
+    Every budgeted view stays in its budget
+    """
+
+    def request(self, url_name, method='get', data=None):
+        with assert_query_budget(url_name):
+            response = getattr(self.client, method)(reverse(url_name), data or {})
+        self.assertIn(response.status_code, (200, 302))
+        return response
+
+    def test_principal_index(self):
+        self.login(self.school['principal'])
+        self.request('principal_index')
+        self.request('principal_index', 'post', {'class': self.school['class_ids'][0]})
+
+    def test_student_index(self):
+        self.login(self.school['students'][0][0])
+        self.request('student_index')
+
+    def test_teacher_report_view_single(self):
+        self.login(self.school['teachers'][0])
+        self.request('teacher_report_view_single')
+        student_id = self.school['student_ids'][0][0]
+        self.request('teacher_report_view_single', 'post', {'student': student_id})
+        self.request('teacher_report_view_single', 'post', {'student': student_id, 'from_date': str(live_from())})
+
+    def test_teacher_report_class(self):
+        self.login(self.school['teachers'][0])
+        self.request('teacher_report_class')
+        subject_id = self.school['subject_ids'][0][0]
+        self.request('teacher_report_class', 'post', {'subject': subject_id})
+        self.request('teacher_report_class', 'post', {'subject': subject_id, 'from_date': str(live_from())})
+
+    def test_teacher_attendance_today(self):
+        self.login(self.school['teachers'][0])
+        student_ids = self.school['student_ids'][0]
+        self.request('teacher_attendance_today')
+        # the first attendance of the day, a change of it, and the same attendance again
+        self.request('teacher_attendance_today', 'post', {'student_' + str(student_id): 'on'
+                                                          for student_id in student_ids[1:]})
+        self.request('teacher_attendance_today', 'post', {'student_' + str(student_id): 'on'
+                                                          for student_id in student_ids[2:]})
+        self.request('teacher_attendance_today', 'post', {'student_' + str(student_id): 'on'
+                                                          for student_id in student_ids[2:]})
+        self.request('teacher_attendance_today')
+
+    def test_nested_recorders(self):
+        with QueryRecorder() as outer:
+            with QueryRecorder() as inner:
+                for connection in connections.all():
+                    connection.cursor().execute('SELECT 1')
+            for connection in connections.all():
+                # back to the outer recorder, on every database
+                self.assertIs(connection.query_recorder, outer)
+        self.assertEqual(len(inner), len(connections.all()))
+        self.assertEqual(len(outer), len(connections.all()))
+        for connection in connections.all():
+            self.assertNotIn('query_recorder', connection.__dict__)
+
+
+####################################################
+#           Query plans                            #
+####################################################
+
+# A full scan of one of the app's tables, as written by SQLite ("SCAN TABLE x" before 3.36, "SCAN x" after)
+TABLE_SCAN = re.compile(r'^SCAN (TABLE )?(attendance_\w+)')
+
+# tables the views read whole
+WHOLE_TABLES = {'attendance_class'}
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are only checked on SQLite')
+class QueryPlanTests(SchoolTestCase):
+    """
+    Every query the views run searches an index instead of scanning one of the app's tables.
+    The school wide exports and statistics read every row by design and are not checked.
+    """
+
+    def assert_no_table_scan(self, url_name, method='get', data=None):
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(self.client, method)(reverse(url_name), data or {})
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertIn(response.status_code, (200, 302))
+        scans = []
+        with connection.cursor() as cursor:
+            for query in captured.captured_queries:
+                if not query['sql'].startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                plan = [row[-1] for row in cursor.fetchall()]
+                if any(match and match.group(2) not in WHOLE_TABLES for match in map(TABLE_SCAN.match, plan)):
+                    scans.append('{0}\n    {1}'.format(query['sql'], '\n    '.join(plan)))
+        self.assertFalse(scans, '{0} scans a table in:\n{1}'.format(url_name, '\n'.join(scans)))
+
+    def test_principal_views(self):
+        self.login(self.school['principal'])
+        self.assert_no_table_scan('principal_index')
+        self.assert_no_table_scan('principal_index', 'post', {'class': self.school['class_ids'][0]})
+
+    def test_student_views(self):
+        self.login(self.school['students'][0][0])
+        self.assert_no_table_scan('student_index')
+
+    def test_teacher_report_views(self):
+        self.login(self.school['teachers'][0])
+        student_id = self.school['student_ids'][0][0]
+        subject_id = self.school['subject_ids'][0][0]
+        self.assert_no_table_scan('teacher_report_view_single', 'post', {'student': student_id})
+        self.assert_no_table_scan('teacher_report_view_single', 'post',
+                                  {'student': student_id, 'from_date': str(live_from())})
+        self.assert_no_table_scan('teacher_report_class', 'post', {'subject': subject_id})
+        self.assert_no_table_scan('teacher_report_class', 'post', {'subject': subject_id,
+                                                                   'from_date': str(live_from())})
+        self.assert_no_table_scan('teacher_report_class_export', data={'subject': subject_id})
+
+    def test_teacher_attendance_views(self):
+        self.login(self.school['teachers'][0])
+        student_ids = self.school['student_ids'][0]
+        self.assert_no_table_scan('teacher_attendance_today')
+        self.assert_no_table_scan('teacher_attendance_today', 'post', {'student_' + str(student_id): 'on'
+                                                                       for student_id in student_ids[1:]})
+        self.assert_no_table_scan('teacher_attendance_edit')
+        self.assert_no_table_scan('teacher_attendance_edit', 'post', {str(student_id): 'on'
+                                                                      for student_id in student_ids[2:]})
+
+    def test_teacher_test_and_student_views(self):
+        self.login(self.school['teachers'][0])
+        test = Test.objects.filter(subject_id=self.school['subject_ids'][0][0]).first()
+        self.assert_no_table_scan('teacher_test_edit')
+        self.assert_no_table_scan('teacher_test_edit', 'post', {'test': test.name, 'edit': 'on'})
+        data = {'test': test.name, 'total_mark': test.total_marks}
+        data.update({str(mark_id): 1 for mark_id in Marks.objects.filter(test=test).values_list('id', flat=True)})
+        self.assert_no_table_scan('teacher_test_edit', 'post', data)
+        self.assert_no_table_scan('teacher_student_edit')
+
+
+####################################################
+#           Attendance stores                      #
+####################################################
+
+
+class StoreTests(TestCase):
+    """
+    The same attendance saved through both stores, over days crossing a month and a term boundary,
+    and corrected afterwards
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        which_class = Class.objects.create(grade=2, division='B')
+        cls.student_ids = []
+        for roll_no in range(1, 6):
+            user = User.objects.create_user('store{0}'.format(roll_no))
+            cls.student_ids.append(Student.objects.create(
+                user=user, which_class=which_class, phone=9100000000 + roll_no, roll_no=roll_no,
+                name='Store {0}'.format(roll_no)).id)
+        start = datetime.date(2023, 10, 16)
+        cls.days = [start + datetime.timedelta(days=offset) for offset in range(30)]
+        cls.row_changes = []
+        cls.packed_changes = []
+        rng = random.Random(2023)
+        saves = [(day, [student_id for student_id in cls.student_ids if rng.random() < 0.7]) for day in cls.days]
+        # corrections of past days, and the last student absent from late october on, across the new term
+        saves += [(rng.choice(cls.days), [student_id for student_id in cls.student_ids if rng.random() < 0.5])
+                  for _ in range(10)]
+        saves += [(cls.days[9], cls.student_ids)] + [(day, cls.student_ids[:-1]) for day in cls.days[10:]]
+        for day, present_ids in saves:
+            cls.row_changes.append(RowStore().save(cls.student_ids, day, present_ids))
+            cls.packed_changes.append(PackedStore().save(cls.student_ids, day, present_ids))
+
+    def test_saves_report_the_same_changes(self):
+        self.assertEqual([sorted(changes) for changes in self.row_changes],
+                         [sorted(changes) for changes in self.packed_changes])
+
+    def test_counts_match(self):
+        self.assertEqual(RowStore().count_complete(self.student_ids), PackedStore().count_complete(self.student_ids))
+        ranges = [(datetime.date.min, datetime.date(2023, 10, 31)), ('', datetime.date(2023, 11, 1)),
+                  (datetime.date(2023, 10, 31), datetime.date(2023, 11, 1)),
+                  (datetime.date(2023, 11, 1), datetime.date(2023, 11, 30)),
+                  (datetime.date(2023, 10, 20), datetime.date(2023, 11, 10)),
+                  (datetime.date(2024, 1, 1), datetime.date(2024, 2, 1))]
+        for from_date, to_date in ranges:
+            counts = RowStore().count_from_to(self.student_ids, from_date or datetime.date.min, to_date)
+            self.assertEqual(counts, PackedStore().count_from_to(self.student_ids, from_date or datetime.date.min,
+                                                                  to_date), (from_date, to_date))
+            for student_id in self.student_ids:
+                attendance_list = Attendance.objects.filter(student_id=student_id, date__lte=to_date)
+                if from_date:
+                    attendance_list = attendance_list.filter(date__gte=from_date)
+                expected = (attendance_list.filter(is_present=True).count(), attendance_list.count())
+                self.assertEqual(counts.get(student_id, (0, 0)), expected, (student_id, from_date, to_date))
+
+    def test_days_match(self):
+        student_list = list(Student.objects.filter(id__in=self.student_ids))
+        for day in self.days:
+            self.assertEqual(set(RowStore().absent_ids(day).values_list('student_id', flat=True)),
+                             set(PackedStore().absent_ids(day)), day)
+            self.assertEqual([(a.student.id, a.is_present) for a in RowStore().day_list(student_list, day)],
+                             [(a.student.id, a.is_present) for a in PackedStore().day_list(student_list, day)])
+
+    def test_history_and_streaks_match(self):
+        self.assertEqual(RowStore().history(self.student_ids), PackedStore().history(self.student_ids))
+        for student_id in self.student_ids:
+            self.assertEqual(RowStore().absence_streak(student_id), PackedStore().absence_streak(student_id))
+        self.assertEqual(PackedStore().absence_streak(self.student_ids[-1]), 20)
+
+    def test_convert_both_ways(self):
+        history = RowStore().history(self.student_ids)
+        counts = RowStore().count_complete(self.student_ids)
+        rollup_rows = sorted(AttendanceRollup.objects.values_list('student_id', 'period', 'start', 'present', 'total'))
+        prefix_rows = sorted(AttendancePrefix.objects.values_list('student_id', 'date', 'ordinal', 'present', 'total'))
+        call_command('convert_attendance_store', check=True, stdout=StringIO())
+
+        PackedAttendance.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command('convert_attendance_store', check=True, stdout=StringIO())
+        call_command('convert_attendance_store', to='packed', stdout=StringIO())
+        self.assertEqual(PackedStore().history(self.student_ids), history)
+        self.assertEqual(PackedStore().count_complete(self.student_ids), counts)
+
+        Attendance.objects.all().delete()
+        call_command('convert_attendance_store', to='rows', stdout=StringIO())
+        self.assertEqual(RowStore().history(self.student_ids), history)
+        self.assertEqual(RowStore().count_complete(self.student_ids), counts)
+        self.assertEqual(sorted(AttendanceRollup.objects.values_list(
+            'student_id', 'period', 'start', 'present', 'total')), rollup_rows)
+        self.assertEqual(sorted(AttendancePrefix.objects.values_list(
+            'student_id', 'date', 'ordinal', 'present', 'total')), prefix_rows)
+
+
+class RangeCountTests(TestCase):
+    """
+    Date range counts of the prefix rows around the month, term and year boundaries, the days being saved out of
+    order and corrected afterwards
+    """
+    boundaries = [datetime.date(2023, 6, 1), datetime.date(2023, 7, 1), datetime.date(2023, 11, 1),
+                  datetime.date(2024, 1, 1)]
+
+    @classmethod
+    def setUpTestData(cls):
+        which_class = Class.objects.create(grade=3, division='C')
+        cls.student_ids = []
+        for roll_no in range(1, 5):
+            user = User.objects.create_user('range{0}'.format(roll_no))
+            cls.student_ids.append(Student.objects.create(
+                user=user, which_class=which_class, phone=9200000000 + roll_no, roll_no=roll_no,
+                name='Range {0}'.format(roll_no)).id)
+        days = [boundary + datetime.timedelta(days=offset) for boundary in cls.boundaries for offset in range(-3, 3)]
+        rng = random.Random(13)
+        rng.shuffle(days)
+        days += [rng.choice(days) for _ in range(8)]
+        for day in days:
+            # the first student only has attendance from the second boundary on
+            student_ids = cls.student_ids[1:] if day < cls.boundaries[1] else cls.student_ids
+            save_attendance(student_ids, day, [student_id for student_id in student_ids if rng.random() < 0.6])
+
+    def direct_count(self, student_id, from_date, to_date):
+        attendance_list = Attendance.objects.filter(student_id=student_id, date__gte=from_date, date__lte=to_date)
+        return attendance_list.filter(is_present=True).count(), attendance_list.count()
+
+    def test_counts_around_boundaries(self):
+        one_day = datetime.timedelta(days=1)
+        dates = [datetime.date.min] + [boundary + one_day * offset for boundary in self.boundaries
+                                       for offset in (-1, 0, 1)]
+        for from_date in dates:
+            for to_date in dates[1:]:
+                if to_date < from_date:
+                    continue
+                counts = rollups.count_from_to(self.student_ids, from_date, to_date)
+                for student_id in self.student_ids:
+                    self.assertEqual(counts.get(student_id, (0, 0)), self.direct_count(student_id, from_date, to_date),
+                                     (student_id, from_date, to_date))
+
+    def test_stored_rows_match_a_rebuild(self):
+        expected = rollups.compute_prefixes(Attendance.objects.all())
+        self.assertEqual({(student_id, date): [ordinal, present, total] for student_id, date, ordinal, present, total
+                          in AttendancePrefix.objects.values_list('student_id', 'date', 'ordinal', 'present', 'total')},
+                         {key: list(value) for key, value in expected.items()})
+        expected = rollups.compute_rollups(Attendance.objects.all())
+        self.assertEqual({(student_id, period, start): [present, total] for student_id, period, start, present, total
+                          in AttendanceRollup.objects.values_list('student_id', 'period', 'start', 'present', 'total')},
+                         {key: list(value) for key, value in expected.items()})
+
+
+####################################################
+#           Absence trackers                       #
+####################################################
+
+
+class AbsenceTrackerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        which_class = Class.objects.create(grade=5, division='E')
+        cls.student_ids = []
+        for roll_no in range(1, 4):
+            user = User.objects.create_user('tracked{0}'.format(roll_no))
+            cls.student_ids.append(Student.objects.create(
+                user=user, which_class=which_class, phone=9400000000 + roll_no, roll_no=roll_no,
+                name='Tracked {0}'.format(roll_no)).id)
+        cls.start = datetime.date(2023, 7, 3)
+
+    def day(self, number):
+        return self.start + datetime.timedelta(days=number)
+
+    def trackers(self):
+        return {tracker.student_id: tuple(getattr(tracker, field) for field in absence.FIELDS)
+                for tracker in AbsenceTracker.objects.all()}
+
+    def recounted(self):
+        return {tracker.student_id: tuple(getattr(tracker, field) for field in absence.FIELDS)
+                for tracker in absence.build_trackers(self.student_ids)}
+
+    def test_streak_follows_changes_of_past_days(self):
+        student_id = self.student_ids[0]
+        for number, is_present in enumerate([True, True, False, False, False]):
+            save_attendance([student_id], self.day(number), [student_id] if is_present else [])
+        tracker = AbsenceTracker.objects.get(student_id=student_id)
+        self.assertEqual((tracker.streak, tracker.at_risk), (3, True))
+        # present on the middle day of the streak
+        save_attendance([student_id], self.day(3), [student_id])
+        tracker.refresh_from_db()
+        self.assertEqual(tracker.streak, 1)
+        # the last day edited twice
+        save_attendance([student_id], self.day(4), [student_id])
+        save_attendance([student_id], self.day(4), [])
+        tracker.refresh_from_db()
+        self.assertEqual(tracker.streak, 1)
+        # a day taken late, before the last day
+        save_attendance([student_id], self.day(-1), [])
+        save_attendance([student_id], self.day(2), [student_id])
+        tracker.refresh_from_db()
+        self.assertEqual((tracker.streak, tracker.window_days, tracker.window), (1, 6, 0b011110))
+        self.assertEqual(self.trackers(), self.recounted())
+
+    def test_trackers_match_a_recount_after_every_save(self):
+        rng = random.Random(24)
+        for number in range(60):
+            # mostly the next days, some of them back dated, over more days than the window
+            day = self.day(number if rng.random() < 0.7 else rng.randrange(number + 1))
+            student_ids = rng.sample(self.student_ids, rng.randint(1, len(self.student_ids)))
+            save_attendance(student_ids, day, [student_id for student_id in student_ids if rng.random() < 0.6])
+            self.assertEqual(self.trackers(), self.recounted(), (number, day))
+
+    def test_rebuild_command(self):
+        rng = random.Random(7)
+        for number in range(10):
+            save_attendance(self.student_ids, self.day(number),
+                            [student_id for student_id in self.student_ids if rng.random() < 0.5])
+        expected = self.trackers()
+        AbsenceTracker.objects.filter(student_id=self.student_ids[0]).delete()
+        AbsenceTracker.objects.filter(student_id=self.student_ids[1]).update(streak=0, window=0, at_risk=True)
+        call_command('rebuild_absence_trackers', stdout=StringIO())
+        self.assertEqual(self.trackers(), expected)
+        call_command('convert_attendance_store', to='packed', stdout=StringIO())
+        with self.settings(ATTENDANCE_STORE='packed'):
+            call_command('rebuild_absence_trackers', stdout=StringIO())
+        self.assertEqual(self.trackers(), expected)
+
+
+####################################################
+#           Roster import                          #
+####################################################
+
+
+ROSTER = """username,password,full_name,phone,roll
+new1,secret,New One,9300000001,2
+new2,secret,New Two,9300000002,2
+taken,secret,Taken User,9300000003,3
+new1,secret,New One Again,9300000004,4
+new3,secret,New Three,123,5
+new4,secret,New Four,phone,6
+new5,secret,New Five,9300000005,1
+new6,secret,New Six,9300000006,7
+"""
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class RosterImportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Group.objects.create(name='Student')
+        cls.which_class = Class.objects.create(grade=4, division='D')
+        Student.objects.create(user=User.objects.create_user('taken'), which_class=cls.which_class,
+                               phone=9300000000, roll_no=1, name='Taken')
+        subject = Subject.objects.create(name='Maths', which_class=cls.which_class)
+        cls.live_test = Test.objects.create(subject=subject, total_marks=10, name='Live', date=live_from())
+        Test.objects.create(subject=subject, total_marks=10, name='Archived',
+                            date=live_from() - datetime.timedelta(days=30))
+
+    def test_invalid_rows_are_reported_and_not_written(self):
+        added, errors = roster.import_roster(ROSTER.splitlines(), self.which_class)
+        self.assertEqual(added, 2)
+        self.assertEqual([line for line, _ in errors], [3, 4, 5, 6, 7, 8])
+        self.assertEqual(sorted(Student.objects.filter(which_class=self.which_class).values_list('roll_no', 'name')),
+                         [(1, 'Taken'), (2, 'New One'), (7, 'New Six')])
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['new1', 'new6', 'taken'])
+        self.assertEqual(set(Group.objects.get(name='Student').user_set.values_list('username', flat=True)),
+                         {'new1', 'new6'})
+        # only the tests of the current academic year get a mark
+        self.assertEqual(sorted(Marks.objects.values_list('student__name', 'test_id', 'marks')),
+                         [('New One', self.live_test.id, 0), ('New Six', self.live_test.id, 0)])
+        self.assertTrue(User.objects.get(username='new1').check_password('secret'))
+
+    def test_batch_with_a_username_taken_meanwhile_is_rolled_back(self):
+        validate_roster = roster.validate_roster
+
+        def validate_then_take(rows, class_id):
+            valid, errors = validate_roster(rows, class_id)
+            User.objects.create_user('new6')
+            return valid, errors
+
+        with mock.patch.object(roster, 'validate_roster', validate_then_take), \
+                mock.patch.object(roster, 'BATCH_SIZE', 1):
+            added, errors = roster.import_roster(ROSTER.splitlines(), self.which_class)
+        self.assertEqual(added, 1)
+        self.assertEqual(errors[-1], (9, 'not saved, a username of the batch was taken meanwhile'))
+        self.assertEqual(sorted(Student.objects.values_list('name', flat=True)), ['New One', 'Taken'])
+        self.assertFalse(User.objects.get(username='new6').groups.exists())
+        self.assertEqual(list(Marks.objects.values_list('student__name', flat=True)), ['New One'])
+
+
+####################################################
+#           Absence notifications                  #
+####################################################
+
+
+class StubGateway(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server standing in for the SMS gateway : it records the (to, msg) of every request and answers
+    500 for the numbers in failing, and only after a second for the numbers in slow
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubGatewayHandler)
+        self.received = []
+        self.failing = set()
+        self.slow = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/sendsms'.format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        to = params['to'][0]
+        with self.server.lock:
+            self.server.received.append((to, params['msg'][0]))
+        if to in self.server.slow:
+            time.sleep(1)
+        self.send_response(500 if to in self.server.failing else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class GatewayTestMixin(object):
+
+    @classmethod
+    def setUpClass(cls):
+        super(GatewayTestMixin, cls).setUpClass()
+        cls.gateway = StubGateway()
+        cls.gateway.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.gateway.stop()
+        super(GatewayTestMixin, cls).tearDownClass()
+
+    def setUp(self):
+        self.gateway.received = []
+        self.gateway.failing = set()
+        self.gateway.slow = set()
+
+
+class DispatchTests(GatewayTestMixin, SimpleTestCase):
+
+    def test_dispatch_reports_sent_and_failed(self):
+        self.gateway.failing = {'9000000003', '9000000007'}
+        messages = [(number, str(9000000000 + number), 'message {0}'.format(number)) for number in range(20)]
+        report = sms_sender.dispatch(messages, base_url=self.gateway.url, concurrency=4, timeout=5)
+        self.assertEqual(sorted(report.sent), [number for number in range(20) if number not in (3, 7)])
+        self.assertEqual(sorted(key for key, _ in report.failed), [3, 7])
+        self.assertEqual(sorted(self.gateway.received), sorted((to, msg) for _, to, msg in messages))
+
+    def test_dispatch_times_out(self):
+        self.gateway.slow = {'9000000001'}
+        report = sms_sender.dispatch([(0, '9000000000', 'fast'), (1, '9000000001', 'slow')],
+                                     base_url=self.gateway.url, concurrency=2, timeout=0.2)
+        self.assertEqual(report.sent, [0])
+        self.assertEqual([key for key, _ in report.failed], [1])
+
+
+class OutboxTests(GatewayTestMixin, TestCase):
+    """
+    Absence messages queued in the outbox, the first two students being children of the same parent
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        which_class = Class.objects.create(grade=1, division='A')
+        cls.student_list = []
+        for roll_no in range(1, 4):
+            user = User.objects.create_user('student{0}'.format(roll_no))
+            cls.student_list.append(Student.objects.create(
+                user=user, which_class=which_class, phone=9000000000 + roll_no, roll_no=roll_no,
+                name='Student {0}'.format(roll_no)))
+            if roll_no < 3:
+                Parent.objects.create(student=user, email='parent@example.com', phone=9876543210, name='Parent')
+        cls.student_ids = [student.id for student in cls.student_list]
+        cls.day = live_from()
+
+    def take(self, absent):
+        save_attendance(self.student_ids, self.day, [student.id for student in self.student_list
+                                                     if student not in absent])
+
+    def test_one_message_per_contact(self):
+        self.take(self.student_list)
+        self.assertEqual(sms_sender.queue_absent_messages(self.day), 2)
+        parent = OutboxMessage.objects.get(recipient='9876543210')
+        self.assertIn('Student 1', parent.message)
+        self.assertIn('Student 2', parent.message)
+        self.assertEqual(OutboxMessage.objects.get(recipient='9000000003').sequence, 0)
+        self.assertEqual(sms_sender.queue_absent_messages(self.day), 0)
+
+    def test_follow_up_for_children_marked_absent_later(self):
+        self.take(self.student_list[:1])
+        self.assertEqual(sms_sender.queue_absent_messages(self.day), 1)
+        self.take(self.student_list[:2])
+        self.assertEqual(sms_sender.queue_absent_messages(self.day), 1)
+        follow_up = OutboxMessage.objects.get(recipient='9876543210', sequence=1)
+        self.assertIn('Student 2', follow_up.message)
+        self.assertNotIn('Student 1', follow_up.message)
+        self.assertEqual(follow_up.student_ids, str(self.student_ids[1]))
+        self.assertEqual(sms_sender.queue_absent_messages(self.day), 0)
+
+    def test_messages_queued_by_another_run_are_skipped(self):
+        self.take(self.student_list)
+        get_absent_digests = sms_sender.get_absent_digests
+
+        def racing_digests(date, channel):
+            # another run queues the parent's message between the read and the insert
+            digests = get_absent_digests(date, channel)
+            OutboxMessage.objects.create(recipient='9876543210', date=date, message='queued by another run',
+                                         student_ids=','.join(str(student_id) for student_id in self.student_ids[:2]))
+            return digests
+
+        with mock.patch.object(sms_sender, 'get_absent_digests', racing_digests):
+            self.assertEqual(sms_sender.queue_absent_messages(self.day), 1)
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+        self.assertEqual(OutboxMessage.objects.get(recipient='9876543210').message, 'queued by another run')
+
+    def process(self):
+        return sms_sender.process_outbox(base_url=self.gateway.url, timeout=5)
+
+    def make_due(self):
+        OutboxMessage.objects.update(next_attempt=timezone.now() - datetime.timedelta(seconds=1))
+
+    def test_failed_messages_back_off_until_max_attempts(self):
+        self.take(self.student_list)
+        sms_sender.queue_absent_messages(self.day)
+        self.gateway.failing = {'9876543210'}
+        before = timezone.now()
+        self.process()
+        after = timezone.now()
+        sent = OutboxMessage.objects.get(recipient='9000000003')
+        self.assertEqual(sent.status, OutboxMessage.SENT)
+        self.assertIsNotNone(sent.sent_at)
+        parent = OutboxMessage.objects.get(recipient='9876543210')
+        self.assertEqual((parent.status, parent.attempts), (OutboxMessage.QUEUED, 1))
+        self.assertNotEqual(parent.last_error, '')
+        delay = datetime.timedelta(seconds=sms_sender.RETRY_DELAY)
+        self.assertTrue(before + delay <= parent.next_attempt <= after + delay)
+        # not due yet, so nothing is sent
+        self.process()
+        self.assertEqual(len(self.gateway.received), 2)
+        for attempts in range(2, sms_sender.MAX_ATTEMPTS + 1):
+            self.make_due()
+            before = timezone.now()
+            self.process()
+            after = timezone.now()
+            parent.refresh_from_db()
+            self.assertEqual(parent.attempts, attempts)
+            delay = datetime.timedelta(seconds=sms_sender.RETRY_DELAY * 2 ** (attempts - 1))
+            self.assertTrue(before + delay <= parent.next_attempt <= after + delay)
+            expected = OutboxMessage.FAILED if attempts == sms_sender.MAX_ATTEMPTS else OutboxMessage.QUEUED
+            self.assertEqual(parent.status, expected)
+        self.make_due()
+        self.process()
+        self.assertEqual(len(self.gateway.received), 1 + sms_sender.MAX_ATTEMPTS)
+        self.assertEqual(sms_sender.queue_absent_messages(self.day), 0)
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+
+    def test_expired_claims_are_taken_again(self):
+        self.take(self.student_list)
+        sms_sender.queue_absent_messages(self.day)
+        self.assertEqual(len(sms_sender.claim_messages()), 2)
+        self.assertEqual(set(OutboxMessage.objects.values_list('status', flat=True)), {OutboxMessage.SENDING})
+        # claims still running are left to their worker
+        self.assertEqual(self.process().sent, [])
+        self.make_due()
+        self.assertEqual(len(self.process().sent), 2)
+        self.assertEqual(set(OutboxMessage.objects.values_list('status', flat=True)), {OutboxMessage.SENT})
+        self.assertEqual(len(self.gateway.received), 2)
+
+
+####################################################
+#           Read replica routing                   #
+####################################################
+
+
+REPLICA_MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'attendance.routers.ReplicaMiddleware',
+]
+
+
+@skipUnless(routers.get_replica_alias(), 'needs a replica database in DATABASES')
+@override_settings(ROOT_URLCONF='attendance.tests', MIDDLEWARE=REPLICA_MIDDLEWARE,
+                   DATABASE_ROUTERS=['attendance.routers.ReplicaRouter'],
+                   REPLICA_VIEWS=['replica_read', 'replica_write'])
+class ReplicaRoutingTests(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        user = User.objects.create_user('teacher', password='password')
+        self.client.force_login(user)
+
+    def get(self, url_name):
+        """
+        returns the response and the sql of the queries of the request on the primary and on the replica
+        """
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as primary, \
+                CaptureQueriesContext(connections[routers.get_replica_alias()]) as replica:
+            response = self.client.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        return response, [query['sql'] for query in primary], [query['sql'] for query in replica]
+
+    def test_report_view_reads_replica(self):
+        response, primary, replica = self.get('replica_read')
+        self.assertTrue(any('attendance_student' in sql for sql in replica))
+        self.assertFalse(any('attendance_student' in sql for sql in primary))
+        self.assertNotIn(routers.LAST_WRITE_COOKIE, response.cookies)
+
+    def test_auth_and_session_read_primary(self):
+        _, primary, replica = self.get('replica_read')
+        for table in ('django_session', 'auth_user'):
+            self.assertTrue(any(table in sql for sql in primary), table)
+            self.assertFalse(any(table in sql for sql in replica), table)
+
+    def test_other_views_read_primary(self):
+        _, primary, replica = self.get('primary_read')
+        self.assertTrue(any('attendance_student' in sql for sql in primary))
+        self.assertEqual(replica, [])
+
+    def test_write_pins_request_and_client(self):
+        response, primary, replica = self.get('replica_write')
+        self.assertEqual(response.content, b'1')
+        self.assertTrue(any('INSERT' in sql and 'attendance_class' in sql for sql in primary))
+        self.assertFalse(any('attendance_class' in sql for sql in replica))
+        self.assertIn(routers.LAST_WRITE_COOKIE, response.cookies)
+        # the cookie keeps the next report request of the client on the primary
+        _, primary, replica = self.get('replica_read')
+        self.assertTrue(any('attendance_student' in sql for sql in primary))
+        self.assertEqual(replica, [])
@@ -1,18 +1,30 @@
+import codecs
+from functools import partial
+
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.http import HttpResponseRedirect
 
 # Create your views here.
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.datastructures import MultiValueDictKeyError
+from django.utils.dateparse import parse_date
 
 from attendance.forms import LoginForm, ClassForm, TeacherAddForm, TeacherRemoveForm, StudentAddForm, \
     get_StudentRemoveForm
 from attendance.models import Class, Teacher, Student, Subject
 from attendance.helper import *
+from attendance.absence import at_risk_list
+from attendance.archive import first_day, live_from
+from attendance.exports import class_report_rows, csv_response, school_report_rows
+from attendance.report_cache import bump_versions, cached_report
+from attendance.reports import get_marks_matrix, get_report_card, get_subject_report_list
+from attendance.roster import import_roster
+from attendance.school_stats import school_statistics
 
 
 class UserIntegrityFailException(Exception):
@@ -240,7 +252,7 @@ def teacher_add_student(request):
                 if phone_number < 999999999 or phone_number > 10000000000:
                     return HttpResponseRedirect(reverse('teacher_student_add') + "?status=pherror")
                 rol_list = [student.roll_no for student in
-                            Student.objects.filter(which_class__teacher__user=request.user)]
+                            Student.objects.filter(which_class_id=request.class_id)]
                 roll = form.cleaned_data['roll']
                 if roll in rol_list:
                     raise RollNoExistsError
@@ -252,9 +264,10 @@ def teacher_add_student(request):
                 student.name = form.cleaned_data['full_name']
                 student.phone = phone_number
                 student.roll_no = form.cleaned_data['roll']
-                student.which_class = Class.objects.get(teacher__user=request.user)
+                student.which_class = request.which_class
                 student.save()
-                for test in Test.objects.filter(subject__which_class__teacher__user=request.user):
+                # the tests of past years are archived, their marks too
+                for test in Test.objects.filter(subject__which_class_id=request.class_id, date__gte=live_from()):
                     mark = Marks()
                     mark.test = test
                     mark.student = student
@@ -274,10 +287,37 @@ def teacher_add_student(request):
         return render(request, 'attendance/teacher_student_add.html', context)
 
 
+@teacher_login_required
+def teacher_student_import(request):
+    """
+    Adds the students of an uploaded CSV roster (roster) to the class of the teacher, see attendance.roster.
+    The rows with an error are listed on the result page, the others are added
+    """
+    context = get_error_context(request)
+    if request.method == 'POST':
+        try:
+            added, errors = import_roster(codecs.iterdecode(request.FILES['roster'], 'utf-8-sig'),
+                                          request.which_class)
+        except (MultiValueDictKeyError, ValueError, UnicodeDecodeError):
+            return HttpResponseRedirect(reverse('teacher_student_import') + "?status=formerror")
+        '''
+        !--- Context details ---!
+        * added : number of students added
+        * errors : list of (line number, message) of the rows that were not added
+        '''
+        context['added'] = added
+        context['errors'] = errors
+        return render(request, 'attendance/teacher_student_import_result.html', context)
+    else:
+        '''Form
+        * CSV file (roster) with the columns username, password, full_name, phone, roll
+        '''
+        return render(request, 'attendance/teacher_student_import.html', context)
+
+
 @teacher_login_required
 def teacher_remove_student(request):
-    teacher = Teacher.objects.get(user=request.user)
-    query_set = Student.objects.filter(which_class=teacher.which_class)
+    query_set = Student.objects.filter(which_class_id=request.class_id)
 
     if request.method == 'POST':
         form = get_StudentRemoveForm(query_set, request.POST)
@@ -301,46 +341,76 @@ def teacher_remove_student(request):
 
 @teacher_login_required
 def teacher_student_edit(request):
-    student_list = Student.objects.filter(which_class__teacher__user=request.user).order_by('roll_no')
+    student_list = Student.objects.filter(which_class_id=request.class_id).order_by('roll_no')
     if request.method == "POST":
         '''
-        Iterate student list and save details, after verifying roll_no
+        Validate the details of every student, then save all of them in one transaction
         '''
+        classes = {which_class.id: which_class for which_class in Class.objects.all()}
+        student_list = list(student_list.select_related('user'))
+        deleted = []
+        details = {}
         roll_list = set()
-        for student in student_list:
-            string = 'student_' + str(student.id) + '_'
-            if string + 'delete' in request.POST:
-                student.user.delete()
-                student.delete()
-                continue
-            roll = int(request.POST[string + 'roll'])
-            if roll not in roll_list:
+        try:
+            for student in student_list:
+                string = 'student_' + str(student.id) + '_'
+                if string + 'delete' in request.POST:
+                    deleted.append(student)
+                    continue
+                roll = int(request.POST[string + 'roll'])
+                if roll in roll_list:
+                    return HttpResponseRedirect(reverse('teacher_student_edit') + "?status=rollerror")
                 roll_list.add(roll)
-            else:
-                return HttpResponseRedirect(reverse('teacher_student_edit') + "?=status=rollerror")
-        student_list = Student.objects.filter(which_class__teacher__user=request.user)
+                phone_number = int(request.POST[string + 'phone'])
+                if phone_number < 999999999 or phone_number > 10000000000:
+                    return HttpResponseRedirect(reverse('teacher_student_edit') + "?status=pherror")
+                details[student.id] = {
+                    'roll_no': roll,
+                    'phone': phone_number,
+                    'name': request.POST[string + 'full_name'],
+                    'which_class': classes[int(request.POST[string + 'class'])].id,
+                }
+        except (MultiValueDictKeyError, KeyError, ValueError):
+            return HttpResponseRedirect(reverse('teacher_student_edit') + "?status=formerror")
+
+        changed = {}
+        moved = {}
+        passwords = {}
         for student in student_list:
-            string = 'student_' + str(student.id) + '_'
-            student.roll_no = int(request.POST[string + 'roll'])
-            phone_number = int(request.POST[string + 'phone'])
-            if phone_number < 999999999 or phone_number > 10000000000:
-                return HttpResponseRedirect(reverse('teacher_student_edit') + "?status=pherror")
-            student.phone = phone_number
-            student.name = request.POST[string + 'full_name']
-            which_class = Class.objects.get(pk=int(request.POST[string + 'class']))
-            if not student.which_class == which_class:
-                for test in Test.objects.filter(subject__which_class=which_class):
-                    if not Marks.objects.filter(student=student, test=test).exists():
-                        mark = Marks()
-                        mark.test = test
-                        mark.student = student
-                        mark.marks = 0
-                        mark.save()
-            student.which_class = which_class
-            student.save()
-            if request.POST[string + 'new_password'] != "":
-                student.user.set_password(request.POST[string + 'new_password'])
-                student.user.save()
+            if student.id not in details:
+                continue
+            new_details = details[student.id]
+            old_details = {'roll_no': student.roll_no, 'phone': student.phone, 'name': student.name,
+                           'which_class': student.which_class_id}
+            if new_details != old_details:
+                changed[student.id] = new_details
+            if new_details['which_class'] != student.which_class_id:
+                moved[student.id] = new_details['which_class']
+            new_password = request.POST.get('student_' + str(student.id) + '_new_password', '')
+            if new_password != "":
+                passwords[student.user_id] = {'password': make_password(new_password)}
+
+        with transaction.atomic():
+            if deleted:
+                # deletes the students, their marks and attendance along with the users
+                User.objects.filter(id__in=[student.user_id for student in deleted]).delete()
+            bulk_update(Student, changed)
+            bulk_update(User, passwords)
+            if moved:
+                # a 0 mark for every test of the live year of the new class the student has no mark of
+                tests_of = {}
+                for test_id, class_id in Test.objects.filter(subject__which_class_id__in=set(moved.values()),
+                                                             date__gte=live_from()) \
+                        .values_list('id', 'subject__which_class_id'):
+                    tests_of.setdefault(class_id, []).append(test_id)
+                existing = set(Marks.objects.filter(student_id__in=moved).values_list('student_id', 'test_id'))
+                Marks.objects.bulk_create([
+                    Marks(student_id=student_id, test_id=test_id, marks=0)
+                    for student_id, class_id in moved.items()
+                    for test_id in tests_of.get(class_id, [])
+                    if (student_id, test_id) not in existing
+                ])
+            bump_versions([request.class_id] + list(moved.values()))
         return HttpResponseRedirect(reverse('teacher_student_edit') + "?status=success")
     else:
         '''
@@ -359,11 +429,12 @@ def teacher_student_edit(request):
         return render(request, 'attendance/teacher_student_edit.html', context)
 
 
+@teacher_login_required
 def teacher_subject_add(request):
     if request.method == "POST":
         subject = Subject()
         subject.name = request.POST['subject']
-        subject.which_class = Teacher.objects.get(user=request.user).which_class
+        subject.which_class = request.which_class
         subject.save()
         return HttpResponseRedirect(reverse('teacher_subject_add') + "?status=success")
     else:
@@ -376,12 +447,13 @@ def teacher_subject_add(request):
         return render(request, 'attendance/teacher_subject_add.html', context)
 
 
+@teacher_login_required
 def teacher_subject_edit(request):
     """
     To edit and delete subjects in class
     """
     context = get_error_context(request)
-    subject_list = Subject.objects.filter(which_class__teacher__user=request.user)
+    subject_list = Subject.objects.filter(which_class_id=request.class_id)
     if request.method == "POST":
         for subject in subject_list:
             string = str(subject.id) + "_"
@@ -407,7 +479,7 @@ def teacher_subject_edit(request):
 
 @teacher_login_required
 def teacher_test_add(request):
-    student_list = Student.objects.filter(which_class__teacher__user=request.user).order_by('roll_no')
+    student_list = Student.objects.filter(which_class_id=request.class_id).order_by('roll_no')
     if request.method == "POST":
         ''' TASKs
             check if the object exists
@@ -416,37 +488,38 @@ def teacher_test_add(request):
              if yes => Display a filled version of previous form to be edited
 
         '''
-        # Do something
+        subject_list = list(Subject.objects.filter(which_class_id=request.class_id))
+        student_list = list(student_list)
+        # the whole form is read and checked before anything is written
         try:
-            date = request.POST['date']
+            date = parse_date(request.POST['date'])
             name = request.POST['test_name']
             total_marks = int(request.POST['marks_tot'])
-            test_list = []
-            for subject in Subject.objects.filter(which_class__teacher__user=request.user):
-                test = Test()
-                test.date = date
-                test.name = name
-                test.total_marks = total_marks
-                test.subject = subject
-                test.save()
-                test_list.append(test)
-            for test in test_list:
+            marks_list = []
+            for subject in subject_list:
                 for student in student_list:
-                    string = str(test.subject.id) + '_' + str(student.roll_no)
-                    marks = request.POST[string]
-                    mark = Marks()
-                    mark.student = student
-                    mark.test = test
-                    mark.marks = int(marks)
-                    mark.save()
-            return HttpResponseRedirect(reverse('teacher_test_add') + '?status=success')
-
-        except KeyError:
-            raise Exception("keyerr")
-        except IntegrityError:
-            raise Exception("Int")
-        except TypeError:
-            raise Exception("Type")
+                    string = str(subject.id) + '_' + str(student.roll_no)
+                    marks = int(request.POST[string])
+                    if marks < 0 or marks > total_marks:
+                        raise ValueError
+                    marks_list.append((subject, student, marks))
+        except (KeyError, ValueError, TypeError):
+            return HttpResponseRedirect(reverse('teacher_test_add') + '?status=formerror')
+        if date is None or name == "":
+            return HttpResponseRedirect(reverse('teacher_test_add') + '?status=formerror')
+
+        with transaction.atomic():
+            test_dict = {}
+            for subject in subject_list:
+                test = Test(subject=subject, name=name, date=date, total_marks=total_marks)
+                test.save()
+                test_dict[subject.id] = test
+            Marks.objects.bulk_create([
+                Marks(student=student, test=test_dict[subject.id], marks=marks)
+                for subject, student, marks in marks_list
+            ], batch_size=500)
+            bump_versions([request.class_id])
+        return HttpResponseRedirect(reverse('teacher_test_add') + '?status=success')
     else:
         '''Description of form required:
         * Test Name (test_name)
@@ -456,7 +529,7 @@ def teacher_test_add(request):
             > list of TextBox (<subject.id>_<student_roll>)
         '''
         teacher_list = Teacher.objects.all()
-        subject_list = Subject.objects.filter(which_class__teacher__user=request.user)
+        subject_list = Subject.objects.filter(which_class_id=request.class_id)
         context = get_error_context(request)
         context['teacher_list'] = teacher_list
         context['subject_list'] = subject_list
@@ -469,18 +542,19 @@ def teacher_test_edit(request):
     context = get_error_context(request)
     if request.method == "POST":
         test_name = request.POST['test']
-        test_list = Test.objects.filter(name=test_name)
+        # the tests of past years are not edited any more, their marks may be archived
+        test_list = Test.objects.filter(subject__which_class_id=request.class_id, name=test_name,
+                                        date__gte=live_from())
         if 'edit' in request.POST:
             """ When edit checkbox is selected"""
             '''FORM
             * textbox -> name : <mark.id>
             * total_marks -> name : total_mark
             '''
-            test_list = test_list.order_by('name')
-            mark_list = []
-            for student in Student.objects.filter(which_class__teacher__user=request.user).order_by('roll_no'):
-                marks = Marks.objects.filter(student=student, test__name=test_name).order_by('test__subject__name')
-                mark_list.append(marks)
+            test_list = test_list.order_by('subject__name', 'id')
+            student_list = Student.objects.filter(which_class_id=request.class_id).order_by('roll_no')
+            mark_list = [[mark for mark in marks if mark is not None]
+                         for marks in get_marks_matrix(student_list, test_list).rows()]
             context['test_list'] = test_list
             context['mark_list'] = mark_list
             '''
@@ -494,17 +568,23 @@ def teacher_test_edit(request):
             """
             When the delete checkbox is selected.
             """
-            Test.objects.filter(name=test_name).delete()
+            test_list.delete()
         else:
-            """ Editing the test, and marks associated with it"""
-            total_mark = int(request.POST['total_mark'])
-            for test in test_list:
-                test.total_marks = total_mark
-                test.save()
-                marks = Marks.objects.filter(test=test)
-                for mark in marks:
-                    mark.marks = request.POST[str(mark.id)]
-                    mark.save()
+            """ Editing the test, and marks associated with it, only the changed values are written"""
+            try:
+                total_mark = int(request.POST['total_mark'])
+                new_marks = {}
+                for mark_id, marks in Marks.objects.filter(test__in=test_list).values_list('id', 'marks'):
+                    if str(mark_id) in request.POST:
+                        submitted = parse_marks(request.POST[str(mark_id)], total_mark)
+                        if submitted != marks:
+                            new_marks[mark_id] = submitted
+            except ValueError:
+                return HttpResponseRedirect(reverse('teacher_test_select') + '?status=formerror')
+            with transaction.atomic():
+                test_list.exclude(total_marks=total_mark).update(total_marks=total_mark)
+                update_marks(new_marks)
+                bump_versions([request.class_id])
         return HttpResponseRedirect(reverse('teacher_test_select') + '?status=success')
     else:
         '''
@@ -513,7 +593,8 @@ def teacher_test_edit(request):
         * list of test by name
         * 2 checkbox by name edit and delete
         '''
-        test_names = [test.name for test in Test.objects.filter(subject__which_class__teacher__user=request.user)]
+        test_names = [test.name for test in Test.objects.filter(subject__which_class_id=request.class_id,
+                                                                 date__gte=live_from())]
         test_names = set(test_names)
         context['test_names'] = test_names
         return render(request, 'attendance/teacher_test_select.html', context)
@@ -529,43 +610,41 @@ def teacher_report_view_single(request):
         return web page with required content
         '''
         student = Student.objects.get(pk=int(request.POST['student']))
-
-        attendance = get_attendance_complete(student)
-        # for sqlite
-        test_names = set([test.name for test in
-                          Test.objects.filter(subject__which_class__teacher__user=request.user)])
-        ''' With MySql or Postgres
-        test_names = [test.name for test in
-                      Test.objects.filter(subject__which_class__teacher__user=request.user).order_by('date').distinct(
-                          'name')]
-        '''
-        mark_list = []
-        for test_name in test_names:
-            marks = Marks.objects.filter(student=student, test__name=test_name).order_by('test__subject__name')
-            mark_list.append(marks)
+        try:
+            from_date, to_date = get_date_range(request.POST)
+        except ValueError:
+            return HttpResponseRedirect(reverse('teacher_report_view_single') + '?status=formerror')
+        if from_date is None:
+            attendance = get_attendance_complete(student)
+        else:
+            attendance = get_attendance_report_from_to(student, from_date, to_date)
+        mark_list = cached_report(student.which_class_id, 'report_card', (student.id, first_day(from_date), to_date),
+                                  partial(get_report_card, student, from_date, to_date))
         context['student'] = student
+        context['from_date'] = from_date
+        context['to_date'] = to_date
         context['attendance'] = attendance
         context['mark_list'] = mark_list
-        context['subject_list'] = Subject.objects.filter(which_class__teacher__user=request.user)
+        context['subject_list'] = Subject.objects.filter(which_class_id=request.class_id)
         '''
         !--- Context details ---!
         * student
         * from_date
-        * to_date
+        * to_date : both None when the attendance is the complete one
         * attendance :
             > Dictionary with keys : present, absent, total, percentage_present
         * mark_list list of list
-            > the inner list contains the
+            > one inner list per test name, in date order, with the Marks of every subject in that test
         '''
 
         return render(request, 'attendance/teacher_report_single_view.html', context)
     else:
         '''Form Description
-        * Student name
-        * From date
-        * To date
+        * Student name (student)
+        * From date (from_date), YYYY-MM-DD, optional
+        * To date (to_date), YYYY-MM-DD, optional
         '''
-        context['student_list'] = Student.objects.filter(which_class__teacher__user=request.user)
+        context['student_list'] = Student.objects.filter(which_class_id=request.class_id)
         return render(request, 'attendance/teacher_report_single.html', context)
 
 
@@ -578,18 +657,27 @@ def teacher_report_class(request):
         return table with the data
         '''
         subject = Subject.objects.get(pk=int(request.POST['subject']))
-        student_list = Student.objects.filter(which_class__teacher__user=request.user).order_by('roll_no')
-        test_list = Test.objects.filter(subject=subject).order_by('date')
-        mark_list = []
-        attendance_list = []
-        for student in student_list:
-            attendance_list.append(get_attendance_complete(student))
-            student_marks = []
-            for test in test_list:
-                mark = Marks.objects.get(test=test, student=student)
-                student_marks.append(mark)
-            mark_list.append(student_marks)
+        try:
+            from_date, to_date = get_date_range(request.POST)
+        except ValueError:
+            return HttpResponseRedirect(reverse('teacher_report_class') + '?status=formerror')
+
+        def compute_report():
+            student_list = Student.objects.filter(which_class_id=request.class_id).order_by('roll_no')
+            test_list = Test.objects.filter(subject=subject, date__gte=first_day(from_date)).order_by('date', 'id')
+            if to_date is not None:
+                test_list = test_list.filter(date__lte=to_date)
+            if from_date is None:
+                attendance_list = get_attendance_summary(student_list)
+            else:
+                attendance_list = get_attendance_summary_from_to(student_list, from_date, to_date)
+            return get_marks_matrix(student_list, test_list).rows(), attendance_list
+
+        mark_list, attendance_list = cached_report(request.class_id, 'class_report', (subject.id, from_date, to_date),
+                                                   compute_report)
         context['subject'] = subject
+        context['from_date'] = from_date
+        context['to_date'] = to_date
         context['mark_list'] = mark_list
         context['attendance_list'] = attendance_list
         context['data_list'] = zip(attendance_list, mark_list)
@@ -600,32 +688,45 @@ def teacher_report_class(request):
             > one row contains marks of one student in all test of the subject
         * attendance_list: list of attendance of students, dictionary
             > keys: present, absent, total, percentage_present
+            > only between from_date and to_date when they are not None
         '''
         return render(request, 'attendance/teacher_report_class_view.html', context)
     else:
         '''Form
         * Subject List (subject)
+        * From date (from_date), YYYY-MM-DD, optional
+        * To date (to_date), YYYY-MM-DD, optional
         '''
-        context['subject_list'] = Subject.objects.filter(which_class__teacher__user=request.user)
+        context['subject_list'] = Subject.objects.filter(which_class_id=request.class_id)
         return render(request, 'attendance/teacher_report_class.html', context)
 
 
+@teacher_login_required
+def teacher_report_class_export(request):
+    """
+    Downloads the class report of a subject as a CSV file, streamed row by row.
+    Takes the same fields as the teacher_report_class form, in the query string
+    """
+    try:
+        subject = Subject.objects.get(pk=int(request.GET['subject']), which_class_id=request.class_id)
+        from_date, to_date = get_date_range(request.GET)
+    except (MultiValueDictKeyError, ValueError, Subject.DoesNotExist):
+        return HttpResponseRedirect(reverse('teacher_report_class') + '?status=formerror')
+    filename = 'report_{0}_{1}.csv'.format(request.which_class, subject.name).replace(':', '').replace(' ', '_')
+    return csv_response(class_report_rows(request.class_id, subject, from_date, to_date), filename)
+
+
 @teacher_login_required
 def teacher_attendance_today(request):
-    teacher = Teacher.objects.get(user=request.user)
-    student_list = Student.objects.filter(which_class=teacher.which_class)
+    student_list = Student.objects.filter(which_class_id=request.class_id)
     if request.method == "POST":
         '''Task
         Create attendance objects for each student
         and fill with data from form
         '''
-        for student in student_list:
-            string = 'student_' + str(student.id)
-            is_present = string in request.POST
-            attendance = Attendance(student=student)
-            attendance.is_present = is_present
-            attendance.date = timezone.now().date()
-            attendance.save()
+        student_ids = [student.id for student in student_list]
+        present_ids = [student_id for student_id in student_ids if 'student_' + str(student_id) in request.POST]
+        save_attendance(student_ids, timezone.now().date(), present_ids, [request.class_id])
         # return redirect
         return HttpResponseRedirect(reverse('teacher_attendance_today') + "?status=success")
     else:
@@ -637,10 +738,10 @@ def teacher_attendance_today(request):
         for each student in class
         * Student name as label, checkbox to determine present or not
         '''
-        attendance = Attendance.objects.filter(student__which_class__teacher__user=request.user).filter(
-            date=timezone.now().date()).order_by('student__roll_no')
+        attendance = get_attendance_of_day(student_list.order_by('roll_no'), timezone.now().date())
         context = get_error_context(request)
-        if attendance.count() != 0:
+        context['at_risk_list'] = at_risk_list(request.class_id)
+        if len(attendance) != 0:
             present = 0
             absent = 0
             for a in attendance:
@@ -649,39 +750,40 @@ def teacher_attendance_today(request):
                 else:
                     absent += 1
             try:
-                percentage = float(present) / attendance.count() * 100
+                percentage = float(present) / len(attendance) * 100
             except ZeroDivisionError:
                 percentage = 0.0
             context['absent'] = absent
             context['present'] = present
-            context['total'] = attendance.count()
+            context['total'] = len(attendance)
             percentage = "{0:.2f}".format(percentage)
             context['percentage'] = percentage
+            '''
+            -----Context details-----
+            * at_risk_list -> AbsenceTracker objects of the students of the class at risk of chronic absence,
+                              with the student, the current streak (streak) and the window
+            '''
             return render(request, 'attendance/teacher_attendance_taken.html', context)
         context['student_list'] = student_list.order_by('roll_no')
         return render(request, 'attendance/teacher_attendance.html', context)
         # attendance, student_list
 
 
+@teacher_login_required
 def teacher_attendance_edit(request):
     context = get_error_context(request)
-    attendance_list = Attendance.objects.filter(student__which_class__teacher__user=request.user).filter(
-        date=timezone.now().date()).order_by('student__roll_no')
-    print(timezone.now())
+    attendance_list = get_attendance_of_day(
+        Student.objects.filter(which_class_id=request.class_id).order_by('roll_no'), timezone.now().date())
     if request.method == 'POST':
-        for attendance in attendance_list:
-            if str(attendance.student.id) in request.POST:
-                attendance.is_present = True
-            else:
-                attendance.is_present = False
-            attendance.save()
+        student_ids = [attendance.student_id for attendance in attendance_list]
+        present_ids = [student_id for student_id in student_ids if str(student_id) in request.POST]
+        save_attendance(student_ids, timezone.now().date(), present_ids, [request.class_id])
         return HttpResponseRedirect(reverse('teacher_attendance_today') + "?status=success")
     else:
         '''Form details
         * List of student
         * checkbox to see if they present : name - <student.id>
         '''
-        print(attendance_list)
         context['attendance_list'] = attendance_list
         return render(request, 'attendance/teacher_attendance_edit_student.html', context)
 
@@ -702,20 +804,10 @@ Views :
 @student_login_required
 def student_index(request):
     context = get_error_context(request)
-    student = Student.objects.get(user=request.user)
+    student = Student.objects.select_related('which_class').get(user=request.user)
     attendance = get_attendance_complete(student)
-    # for sqlite
-    test_names = set([test.name for test in
-                      Test.objects.filter(subject__which_class__student=student)])
-    ''' With MySql or Postgres
-    test_names = [test.name for test in
-                  Test.objects.filter(subject__which_class__teacher__user=request.user).order_by('date').distinct(
-                      'name')]
-    '''
-    mark_list = []
-    for test_name in test_names:
-        marks = Marks.objects.filter(student=student, test__name=test_name).order_by('test__subject__name')
-        mark_list.append(marks)
+    mark_list = cached_report(student.which_class_id, 'report_card', (student.id, first_day(), None),
+                              partial(get_report_card, student))
     context['student'] = student
     context['attendance'] = attendance
     context['mark_list'] = mark_list
@@ -728,7 +820,7 @@ def student_index(request):
     * attendance :
         > Dictionary with keys : present, absent, total, percentage_present
     * mark_list list of list
-        > the inner list contains the
+        > one inner list per test name, in date order, with the Marks of every subject in that test
     '''
     return render(request, 'attendance/student_index.html', context)
 
@@ -744,23 +836,18 @@ def principal_index(request):
         '''Task
         return table with the data
         '''
-        student_list = Student.objects.filter(which_class__id=int(request.POST['class'])).order_by('roll_no')
-        attendance_list = []
-        for student in student_list:
-            attendance_list.append(get_attendance_complete(student))
-        subject_report_list = []
-        for subject in Subject.objects.filter(which_class__id=int(request.POST['class'])):
-            mark_list = []
-            for student in student_list:
-                student_marks = []
-                for test in Test.objects.filter(subject=subject):
-                    mark = Marks.objects.get(test=test, student=student)
-                    student_marks.append(mark)
-                mark_list.append(student_marks)
-            subject_report_list.append(mark_list)
-        context['subject_list'] = Subject.objects.filter(which_class__id=int(request.POST['class']))
-        context['subject_report_list'] = zip(Subject.objects.filter(which_class__id=int(request.POST['class'])),
-                                             subject_report_list)
+        class_id = int(request.POST['class'])
+
+        def compute_report():
+            student_list = Student.objects.filter(which_class__id=class_id).order_by('roll_no')
+            subject_list = list(Subject.objects.filter(which_class__id=class_id))
+            subject_report_list = get_subject_report_list(student_list, subject_list)
+            return subject_list, subject_report_list, get_attendance_summary(student_list)
+
+        subject_list, subject_report_list, attendance_list = cached_report(class_id, 'principal_report', (),
+                                                                           compute_report)
+        context['subject_list'] = subject_list
+        context['subject_report_list'] = subject_report_list
         context['attendance_list'] = attendance_list
         context['class'] = Class.objects.get(pk=int(request.POST['class']))
         context['teacher'] = Teacher.objects.get(which_class=context['class'])
@@ -779,5 +866,38 @@ def principal_index(request):
         * Subject List(subject)
         '''
         context['class_list'] = Class.objects.all()
-        print (context['class_list'])
+        # AbsenceTracker objects of the students of the school at risk of chronic absence
+        context['at_risk_list'] = at_risk_list()
         return render(request, 'attendance/principle_index.html', context)
+
+
+@principal_login_required
+def principal_export(request):
+    """
+    Downloads the marks and attendance of the whole school as a CSV file, streamed row by row,
+    or of one class when the query string has a class.
+    The query string can also have a from_date and a to_date (YYYY-MM-DD) to export the tests between them,
+    past years included, instead of the current year
+    """
+    class_id = request.GET.get('class')
+    try:
+        class_id = int(class_id) if class_id else None
+        from_date, to_date = get_date_range(request.GET)
+    except ValueError:
+        return HttpResponseRedirect(reverse('principal_index') + '?status=formerror')
+    filename = 'school_report.csv' if class_id is None else 'class_report_{0}.csv'.format(class_id)
+    return csv_response(school_report_rows(class_id, from_date, to_date), filename)
+
+
+@principal_login_required
+def principal_statistics(request):
+    """
+    School wide statistics of the marks per subject, test and class, and of the attendance
+    """
+    context = get_error_context(request)
+    '''
+    !--- Context details ---!
+    * statistics : see attendance.school_stats.school_statistics
+    '''
+    context['statistics'] = school_statistics()
+    return render(request, 'attendance/principal_statistics.html', context)